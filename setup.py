@@ -143,7 +143,7 @@ setup(
     #
     # For an analysis of "install_requires" vs pip's requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
-    # install_requires=['peppercorn'],  # Optional
+    install_requires=['numpy', 'mrcfile'],  # Optional
 
     # List additional groups of dependencies here (e.g. development
     # dependencies). Users will be able to install these using the "extras"
@@ -183,7 +183,8 @@ setup(
     # For example, the following would provide a command called `sample` which
     # executes the function `main` from this package when invoked:
     entry_points={
-        'pyworkflow.plugin': 'tomoj = tomoj'
+        'pyworkflow.plugin': 'tomoj = tomoj',
+        'console_scripts': ['tomoj_prealign = tomoj.batch:main']
     },
 
     # List additional URLs that are relevant to your project as a dict.
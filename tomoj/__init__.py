@@ -24,19 +24,40 @@
 # *
 # **************************************************************************
 
-import pwem
+import os
+
+from .constants import TOMOJ_CACHE, TOMOJ_CACHE_SIZE, TOMOJ_SCRATCH
 
 
 _logo = ""
 _references = []
 
 
-class Plugin(pwem.Plugin):
-    @classmethod
-    def _defineVariables(cls):
-        pass
+def __getattr__(name):
+    """Define the Plugin class when it is first used, e.g. when Scipion
+    registers the plugin, so that the processing modules and the
+    tomoj_prealign command line do not import Scipion."""
+    if name != 'Plugin':
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+    import pwem
+    import pyworkflow.utils as pwutils
+
+    class Plugin(pwem.Plugin):
+        @classmethod
+        def _defineVariables(cls):
+            cls._defineVar(TOMOJ_CACHE, '')
+            cls._defineVar(TOMOJ_CACHE_SIZE, 10)
+            cls._defineVar(TOMOJ_SCRATCH, '')
 
-    @classmethod
-    def getEnviron(cls):
-        return None
+        @classmethod
+        def getEnviron(cls):
+            """Environment of the external jobs, where this plugin can be imported
+            to run tomoj.pipeline"""
+            environ = pwutils.Environ(os.environ)
+            environ.update({'PYTHONPATH': os.path.dirname(os.path.dirname(__file__))},
+                           position=pwutils.Environ.BEGIN)
+            return environ
 
+    globals()['Plugin'] = Plugin
+    return Plugin
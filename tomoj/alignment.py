@@ -0,0 +1,897 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+In-process implementation of the TomoJ cross-correlation prealignment.
+
+Neighbouring tilts are cosine-stretched perpendicular to the tilt axis,
+band-pass filtered and cross-correlated in batches of FFTs. The relative
+shifts and their global composition are written in the formats of the
+tiltxcorr .prexf and xftoxg (-NumberToFit 0) .prexg outputs, but they are not
+numerically identical to them: composeShifts removes the error of stretching
+about the image center, which tiltxcorr leaves in its shifts, and the filters
+and peak fit differ in their details.
+"""
+
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import mrcfile
+import numpy as np
+
+from tomoj.constants import (FILTER_SIGMA1, FILTER_SIGMA2, FILTER_RADIUS2,
+                             DARK_VIEW_FRACTION, PATCH_SIZE, PATCH_OVERLAP)
+
+TAPER_FRACTION = 0.1
+PAIRS_PER_BATCH = 8
+# Pyramid refinement: size of the correlated regions and search radius (pixels)
+REFINE_SIZE = 512
+REFINE_SEARCH = 4
+# Every STATS_STRIDE-th row and column are sampled to find dark views
+STATS_STRIDE = 8
+# MRC header label with the scaling of the values of integer stacks
+SCALING_LABEL = 'tomoj scale %.9g offset %.9g'
+# affineResample computes bands of this many output pixels at a time, to bound
+# the memory of its temporaries on large views
+RESAMPLE_BLOCK = 2 ** 22
+
+
+def bandPassFilter(shape, sigma1=FILTER_SIGMA1, sigma2=FILTER_SIGMA2,
+                   radius2=FILTER_RADIUS2):
+    """Gaussian band-pass filter for the real FFT of an image of the given
+    shape, following the tiltxcorr conventions: an inverted gaussian
+    high-pass of sigma1 and a gaussian fall-off of sigma2 beyond radius2
+    (all in cycles/pixel)."""
+    fy = np.fft.fftfreq(shape[0])[:, None]
+    fx = np.fft.rfftfreq(shape[1])[None, :]
+    r = np.sqrt(fx ** 2 + fy ** 2)
+    bandPass = np.ones(r.shape, dtype=np.float32)
+    if sigma1 > 0:
+        bandPass *= 1 - np.exp(-r ** 2 / (2 * sigma1 ** 2))
+    if sigma2 > 0:
+        beyond = r > radius2
+        bandPass[beyond] *= np.exp(-(r[beyond] - radius2) ** 2 / (2 * sigma2 ** 2))
+    return bandPass
+
+
+def taperWindow(shape, fraction=TAPER_FRACTION):
+    """Separable cosine window that smoothly takes the image borders to zero."""
+    window = np.ones(shape, dtype=np.float32)
+    for axis, size in enumerate(shape):
+        width = max(1, int(size * fraction))
+        ramp = 0.5 - 0.5 * np.cos(np.pi * (np.arange(width) + 0.5) / width)
+        profile = np.ones(size, dtype=np.float32)
+        profile[:width] = ramp
+        profile[size - width:] = ramp[::-1]
+        window *= profile[:, None] if axis == 0 else profile[None, :]
+    return window
+
+
+def stretchMatrix(stretch, rotationAngle):
+    """2x2 matrix, in (x, y) coordinates, that stretches an image by the given
+    factor perpendicular to a tilt axis at rotationAngle degrees from the
+    vertical."""
+    phi = np.deg2rad(rotationAngle)
+    u = np.array([np.cos(phi), np.sin(phi)])
+    return np.eye(2) + (stretch - 1) * np.outer(u, u)
+
+
+def affineResample(image, matrix, fill=0.0, region=None):
+    """Bilinear resampling of image by a 2x2, 2x3 or 3x3 (x, y) matrix in the
+    IMOD .xf convention, applied about the image center. Pixels mapped from
+    outside the image are set to fill.
+
+    :param region: optional (x0, y0, width, height) part of the output to
+        compute, which may extend beyond the image. The whole image by default.
+    """
+    matrix = np.asarray(matrix)
+    ny, nx = image.shape
+    # Keep every coefficient in single precision so that none of the
+    # per-pixel temporaries below is promoted to float64.
+    cx, cy = np.float32(nx / 2.0), np.float32(ny / 2.0)
+    dx, dy = (matrix[0:2, 2] if matrix.shape[1] > 2 else np.zeros(2)).astype(np.float32)
+    inverse = np.linalg.inv(matrix[0:2, 0:2]).astype(np.float32)
+    x0, y0, width, height = region if region is not None else (0, 0, nx, ny)
+    bandHeight = max(1, RESAMPLE_BLOCK // width)
+    if height > bandHeight:
+        resampled = np.empty((height, width), dtype=np.float32)
+        for start in range(0, height, bandHeight):
+            rows = min(bandHeight, height - start)
+            resampled[start:start + rows] = affineResample(image, matrix, fill,
+                                                           (x0, y0 + start, width, rows))
+        return resampled
+    yy, xx = np.mgrid[y0:y0 + height, x0:x0 + width].astype(np.float32)
+    xx -= cx + dx
+    yy -= cy + dy
+    srcX = inverse[0, 0] * xx + inverse[0, 1] * yy + cx
+    srcY = inverse[1, 0] * xx + inverse[1, 1] * yy + cy
+    del xx, yy
+
+    inside = (srcX >= 0) & (srcX <= nx - 1) & (srcY >= 0) & (srcY <= ny - 1)
+    x0 = np.clip(np.floor(srcX).astype(np.intp), 0, nx - 2)
+    y0 = np.clip(np.floor(srcY).astype(np.intp), 0, ny - 2)
+    wx = np.subtract(srcX, x0, dtype=np.float32)
+    wy = np.subtract(srcY, y0, dtype=np.float32)
+    del srcX, srcY
+
+    resampled = (image[y0, x0] * (1 - wx) * (1 - wy) +
+                 image[y0, x0 + 1] * wx * (1 - wy) +
+                 image[y0 + 1, x0] * (1 - wx) * wy +
+                 image[y0 + 1, x0 + 1] * wx * wy)
+    resampled[~inside] = fill
+    return resampled.astype(np.float32, copy=False)
+
+
+def _subPixelPeak(cc, searchRadius=None):
+    """Location of the maximum of a cross-correlation map, refined by a
+    parabolic fit along each axis and expressed as a signed (x, y) shift.
+    The search can be limited to shifts within searchRadius pixels."""
+    ny, nx = cc.shape
+    if searchRadius is None:
+        iy, ix = np.unravel_index(np.argmax(cc), cc.shape)
+    else:
+        offsets = np.arange(-searchRadius, searchRadius + 1)
+        neighbourhood = cc[np.ix_(offsets % ny, offsets % nx)]
+        iy, ix = np.unravel_index(np.argmax(neighbourhood), neighbourhood.shape)
+        iy, ix = offsets[iy] % ny, offsets[ix] % nx
+
+    def parabolic(minus, center, plus):
+        denominator = minus - 2 * center + plus
+        return 0.0 if denominator == 0 else 0.5 * (minus - plus) / denominator
+
+    dy = parabolic(cc[(iy - 1) % ny, ix], cc[iy, ix], cc[(iy + 1) % ny, ix])
+    dx = parabolic(cc[iy, (ix - 1) % nx], cc[iy, ix], cc[iy, (ix + 1) % nx])
+    shiftX = (ix + nx // 2) % nx - nx // 2 + dx
+    shiftY = (iy + ny // 2) % ny - ny // 2 + dy
+    return np.array([shiftX, shiftY])
+
+
+def _rfft2(images):
+    """rfft2 over the last two axes as complex64, whatever the NumPy version.
+    Images are transformed one at a time, so the temporaries of the FFT (in
+    double precision before NumPy 2) only take a single image."""
+    images = np.asarray(images)
+    spectra = np.empty(images.shape[:-1] + (images.shape[-1] // 2 + 1,), dtype=np.complex64)
+    for index in np.ndindex(images.shape[:-2]):
+        spectra[index] = np.fft.rfft2(images[index])
+    return spectra
+
+
+def _irfft2(spectra, shape):
+    """Inverse of _rfft2 to float32 images of the given shape."""
+    images = np.empty(spectra.shape[:-2] + tuple(shape), dtype=np.float32)
+    for index in np.ndindex(spectra.shape[:-2]):
+        images[index] = np.fft.irfft2(spectra[index], s=shape)
+    return images
+
+
+def _rfftWeights(shape):
+    """Multiplicity of each rfft2 coefficient in the full spectrum, to sum
+    over the full spectrum from the half one."""
+    nx = shape[1]
+    weights = np.full((shape[0], nx // 2 + 1), 2.0, dtype=np.float32)
+    weights[:, 0] = 1
+    if nx % 2 == 0:
+        weights[:, -1] = 1
+    return weights
+
+
+def _peakQuality(cc, norm):
+    """Height of the cross-correlation peak normalized to [-1, 1] by the
+    filtered energy of the two views, and its height over the map noise."""
+    peak = cc.max()
+    deviation = cc.std()
+    return (peak / norm if norm > 0 else 0.0,
+            (peak - cc.mean()) / deviation if deviation > 0 else 0.0)
+
+
+def _subPixelPeaks(ccMaps, searchRadius):
+    """_subPixelPeak of a batch of (n, ny, nx) cross-correlation maps at once,
+    within searchRadius pixels. Return the (n, 2) shifts and the (n,) peak
+    values."""
+    n, ny, nx = ccMaps.shape
+    offsets = np.arange(-searchRadius, searchRadius + 1)
+    neighbourhoods = ccMaps[:, offsets % ny][:, :, offsets % nx]
+    iy, ix = np.unravel_index(neighbourhoods.reshape(n, -1).argmax(axis=1),
+                              neighbourhoods.shape[1:])
+    iy, ix = offsets[iy] % ny, offsets[ix] % nx
+    maps = np.arange(n)
+    peaks = ccMaps[maps, iy, ix]
+
+    def parabolic(minus, plus):
+        denominator = minus - 2 * peaks + plus
+        safe = np.where(denominator == 0, 1, denominator)
+        return np.where(denominator == 0, 0.0, 0.5 * (minus - plus) / safe)
+
+    dy = parabolic(ccMaps[maps, (iy - 1) % ny, ix], ccMaps[maps, (iy + 1) % ny, ix])
+    dx = parabolic(ccMaps[maps, iy, (ix - 1) % nx], ccMaps[maps, iy, (ix + 1) % nx])
+    shifts = np.stack([(ix + nx // 2) % nx - nx // 2 + dx,
+                       (iy + ny // 2) % ny - ny // 2 + dy], axis=1)
+    return shifts, peaks
+
+
+def _prepare(image, matrix, window, region=None):
+    """Normalize, optionally stretch and taper an image, or a region of it,
+    before its FFT."""
+    image = np.asarray(image, dtype=np.float32)
+    image = image - image.mean()
+    if matrix is not None or region is not None:
+        image = affineResample(image, np.eye(2) if matrix is None else matrix,
+                               region=region)
+    return image * window
+
+
+def _pyramid(view, levels):
+    """Mean-subtracted view followed by its successive 2x2 binnings."""
+    pyramid = [np.asarray(view, dtype=np.float32)]
+    pyramid[0] = pyramid[0] - pyramid[0].mean()
+    for _ in range(1, levels):
+        pyramid.append(binImage(pyramid[-1], 2))
+    return pyramid
+
+
+def _levelMatrix(matrix, factor):
+    """Transformation matrix of a view binned by factor."""
+    if matrix is None or factor == 1:
+        return matrix
+    scaled = np.array(matrix, dtype=float)
+    scaled[0:2, 2] /= factor
+    return scaled
+
+
+def _pairStretches(tiltAngles, rotationAngle):
+    """For each (i - 1, i) view pair, the matrix stretching the view at higher
+    tilt to match the one closer to zero, and whether that is view i - 1."""
+    cosines = np.cos(np.deg2rad(tiltAngles))
+    for i in range(1, len(tiltAngles)):
+        ratio = cosines[i - 1] / cosines[i]
+        yield stretchMatrix(max(ratio, 1 / ratio), rotationAngle), ratio < 1
+
+
+def _viewMatrix(transforms, index, stretch):
+    """Matrix used to resample a view: its own transform, if any, followed by
+    the stretch, if any. None when the view is used as is."""
+    if transforms is None:
+        return stretch
+    if stretch is None:
+        return transforms[index]
+    return stretch @ transforms[index]
+
+
+def computeNeighbourShifts(stack, tiltAngles, rotationAngle=0.0,
+                           sigma1=FILTER_SIGMA1, sigma2=FILTER_SIGMA2,
+                           radius2=FILTER_RADIUS2, pairsPerBatch=PAIRS_PER_BATCH,
+                           transforms=None, pairs=None, pyramidLevels=1,
+                           refineSize=REFINE_SIZE, views=None, returnQuality=False):
+    """Shift of every view relative to the previous one in the stack.
+
+    :param stack: (N, ny, nx) array-like of tilt images (can be a memory map).
+    :param tiltAngles: N tilt angles in degrees, in stack order.
+    :param views: indexes in the stack of the N views to align when not all
+        of them are, e.g. to skip excluded views. Views are then correlated
+        with the previous view in this list, and the tilt angles, transforms
+        and result refer to them.
+    :param returnQuality: also return the (N, 2) normalized peak height and
+        peak-to-noise ratio of the correlation of each view with the previous
+        one, at the coarsest pyramid level. The first row is zero.
+    :param rotationAngle: angle from the vertical to the tilt axis (degrees).
+    :param transforms: optional (N, 3, 3) matrices applied on the fly to each
+        view before correlating, so the shifts refer to the transformed views.
+    :param pairs: indexes i of the (i - 1, i) view pairs to correlate, all of
+        them by default. The shifts of the other views are left to zero.
+    :param pyramidLevels: with more than one level, views are correlated as a
+        whole binned by 2^(levels - 1) only, and the shift is then refined at
+        each finer level correlating a central region of refineSize pixels
+        within a few pixels of the previous estimate.
+    :return: (N, 2) array of (x, y) shifts that bring each view onto the
+        previous one; the first row is zero (tiltxcorr .prexf convention).
+        Together with the quality array if returnQuality.
+    """
+    nImages = len(tiltAngles)
+    views = list(range(nImages)) if views is None else list(views)
+    factor = 2 ** (pyramidLevels - 1)
+    shape = tuple(n // factor for n in stack[views[0]].shape)
+    bandPass = bandPassFilter(shape, sigma1 * factor, sigma2 * factor, radius2 * factor)
+    window = taperWindow(shape)
+    stretches = [(np.eye(2), False)] + list(_pairStretches(tiltAngles, rotationAngle))
+
+    shifts = np.zeros((nImages, 2))
+    quality = np.zeros((nImages, 2))
+    weights = _rfftWeights(shape) * bandPass
+    pairs = list(range(1, nImages)) if pairs is None else list(pairs)
+    batch = np.empty((2 * min(pairsPerBatch, max(len(pairs), 1)),) + shape,
+                     dtype=np.float32)
+    # Pyramids are shared by the two pairs of each view
+    pyramids = {}
+
+    def getPyramid(index):
+        if index not in pyramids:
+            pyramids[index] = _pyramid(stack[views[index]], pyramidLevels)
+        return pyramids[index]
+
+    def getMatrices(i):
+        # The view at higher tilt is stretched to match the one closer to zero
+        stretch = np.eye(3)
+        stretch[0:2, 0:2], stretchPrevious = stretches[i]
+        return (_viewMatrix(transforms, i - 1, stretch if stretchPrevious else None),
+                _viewMatrix(transforms, i, None if stretchPrevious else stretch))
+
+    for start in range(0, len(pairs), pairsPerBatch):
+        batchPairs = pairs[start:start + pairsPerBatch]
+        for index in list(pyramids):
+            if index < batchPairs[0] - 1:
+                del pyramids[index]
+
+        for n, i in enumerate(batchPairs):
+            previousMatrix, matrix = getMatrices(i)
+            batch[2 * n] = _prepare(getPyramid(i - 1)[-1],
+                                    _levelMatrix(previousMatrix, factor), window)
+            batch[2 * n + 1] = _prepare(getPyramid(i)[-1],
+                                        _levelMatrix(matrix, factor), window)
+
+        nPairs = len(batchPairs)
+        spectra = _rfft2(batch[:2 * nPairs]).reshape((nPairs, 2) + bandPass.shape)
+        ccSpectra = np.conj(spectra[:, 0]) * spectra[:, 1] * bandPass
+        ccMaps = _irfft2(ccSpectra, shape)
+        if returnQuality:
+            # Bound of the correlation of the filtered views (Cauchy-Schwarz),
+            # one view at a time to keep the temporaries small
+            energies = np.array([[(np.abs(spectrum) ** 2 * weights).sum()
+                                  for spectrum in pairSpectra] for pairSpectra in spectra])
+            norms = np.sqrt(energies[:, 0] * energies[:, 1]) / np.prod(shape)
+
+        for n, i in enumerate(batchPairs):
+            if returnQuality:
+                quality[i] = _peakQuality(ccMaps[n], norms[n])
+            displacement = _subPixelPeak(ccMaps[n]) * factor
+            if pyramidLevels > 1:
+                displacement = _refineDisplacement(getPyramid(i - 1), getPyramid(i),
+                                                   getMatrices(i), displacement,
+                                                   sigma1, sigma2, radius2, refineSize)
+            # Peak gives the displacement of the view in the stretched frame
+            shifts[i] = -np.linalg.solve(stretches[i][0], displacement)
+        # Free the spectra before the views of the next batch are resampled
+        del spectra, ccSpectra, ccMaps
+
+    return (shifts, quality) if returnQuality else shifts
+
+
+def xcorrMemory(shape, pairsPerBatch=PAIRS_PER_BATCH, pyramidLevels=1):
+    """Approximate peak memory in bytes of computeNeighbourShifts on views of
+    the given shape: the pyramids and prepared views of a batch, the filters,
+    and either the FFTs of the batch or the resampling of one view, whichever
+    is larger, as they do not overlap."""
+    pixels = float(np.prod(shape))
+    levelPixels = pixels / 4 ** (pyramidLevels - 1)
+    pyramidBytes = 4 * pixels * sum(4.0 ** -level for level in range(pyramidLevels))
+    # Per pair: the pyramid of one more view and the 2 prepared views
+    pairBytes = pyramidBytes + 8 * levelPixels
+    # Spectra and correlation of the pairs, and the temporaries of the FFT of
+    # a single image (in double precision before NumPy 2)
+    fftBytes = 16 * levelPixels * pairsPerBatch + 32 * levelPixels
+    # Mean-subtracted and tapered view, and the float32 resampling temporaries
+    resampleBytes = 8 * levelPixels + 49 * min(levelPixels, RESAMPLE_BLOCK)
+    return pyramidBytes + pairsPerBatch * pairBytes + 12 * levelPixels + \
+        max(fftBytes, resampleBytes)
+
+
+def fitPairsPerBatch(shape, memoryLimit, pyramidLevels=1):
+    """Largest number of view pairs per FFT batch, up to PAIRS_PER_BATCH, for
+    computeNeighbourShifts to fit within memoryLimit bytes. At least 1."""
+    pairsPerBatch = 1
+    while pairsPerBatch < PAIRS_PER_BATCH and \
+            xcorrMemory(shape, pairsPerBatch + 1, pyramidLevels) <= memoryLimit:
+        pairsPerBatch += 1
+    return pairsPerBatch
+
+
+def _correlatePairs(fileName, tiltAngles, pairs, kwargs):
+    """Worker of computeNeighbourShiftsParallel. Return the result and the
+    CPU time it took."""
+    start = time.process_time()
+    with mrcfile.mmap(fileName, mode='r', permissive=True) as mrc:
+        result = computeNeighbourShifts(mrc.data, tiltAngles, pairs=pairs, **kwargs)
+    return result, time.process_time() - start
+
+
+def computeNeighbourShiftsParallel(fileName, tiltAngles, workers, pairs=None,
+                                   cpuTimes=None, **kwargs):
+    """computeNeighbourShifts on an MRC stack with the view pairs spread over
+    a pool of processes. Every process memory-maps the stack, so views are
+    shared through the page cache instead of being copied between processes.
+    Each process gets a contiguous chunk of pairs to keep reusing pyramids.
+
+    :param workers: number of processes.
+    :param cpuTimes: optional list where the CPU time of every worker process
+        is appended. Nothing is appended when the pairs are correlated in the
+        calling thread.
+    Other parameters as in computeNeighbourShifts.
+    """
+    pairs = list(range(1, len(tiltAngles))) if pairs is None else list(pairs)
+    workers = max(1, min(workers, len(pairs)))
+    if workers == 1:
+        return _correlatePairs(fileName, tiltAngles, pairs, kwargs)[0]
+
+    chunks = [list(chunk) for chunk in np.array_split(pairs, workers)]
+    # Spawned processes do not inherit the threads and locks of the caller
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        results = list(executor.map(_correlatePairs, [fileName] * workers,
+                                    [tiltAngles] * workers, chunks, [kwargs] * workers))
+    if cpuTimes is not None:
+        cpuTimes.extend(cpuTime for _, cpuTime in results)
+    results = [result for result, _ in results]
+    # Each chunk only fills the rows of its own pairs
+    if kwargs.get('returnQuality'):
+        return tuple(sum(result) for result in zip(*results))
+    return sum(results)
+
+
+def _refineDisplacement(previousPyramid, pyramid, matrices, displacement,
+                        sigma1, sigma2, radius2, refineSize):
+    """Refine a coarse displacement going down the pyramid levels, correlating
+    at each of them a central region of the previous view with the region of
+    the view displaced by the current estimate."""
+    previousMatrix, matrix = matrices
+    for level in range(len(pyramid) - 2, -1, -1):
+        factor = 2 ** level
+        ny, nx = pyramid[level].shape
+        size = min(refineSize, ny, nx) // 2 * 2
+        x0, y0 = nx // 2 - size // 2, ny // 2 - size // 2
+        offset = np.round(displacement / factor).astype(int)
+
+        previousRegion = _prepare(previousPyramid[level], _levelMatrix(previousMatrix, factor),
+                                  taperWindow((size, size)), region=(x0, y0, size, size))
+        region = _prepare(pyramid[level], _levelMatrix(matrix, factor),
+                          taperWindow((size, size)),
+                          region=(x0 + offset[0], y0 + offset[1], size, size))
+
+        bandPass = bandPassFilter((size, size), sigma1 * factor, sigma2 * factor,
+                                  radius2 * factor)
+        cc = _irfft2(np.conj(_rfft2(previousRegion)) * _rfft2(region) * bandPass, (size, size))
+        # The coarser estimate is within a pixel or two of the right one
+        displacement = (offset + _subPixelPeak(cc, searchRadius=REFINE_SEARCH)) * factor
+    return displacement
+
+
+def patchGrid(shape, patchSize=PATCH_SIZE, overlap=PATCH_OVERLAP):
+    """Rows and columns of the top-left corners of overlapping square
+    patches covering an image of the given shape. The last patch of each
+    axis is aligned with the border."""
+    step = max(1, int(round(patchSize * (1 - overlap))))
+
+    def corners(size):
+        positions = list(range(0, size - patchSize + 1, step))
+        if positions[-1] != size - patchSize:
+            positions.append(size - patchSize)
+        return positions
+
+    return corners(shape[0]), corners(shape[1])
+
+
+def _patchView(view, matrix):
+    """Mean-subtracted view, optionally transformed, to extract patches from."""
+    view = np.asarray(view, dtype=np.float32)
+    view = view - view.mean()
+    return view if matrix is None else affineResample(view, matrix)
+
+
+def _viewPatches(view, rows, columns, patchSize, window):
+    """Patches of a view, each one normalized and tapered:
+    (len(rows) * len(columns), patchSize, patchSize) array."""
+    patches = np.lib.stride_tricks.sliding_window_view(view, (patchSize, patchSize))
+    patches = patches[rows][:, columns].reshape(-1, patchSize, patchSize)
+    return (patches - patches.mean(axis=(1, 2), keepdims=True)) * window
+
+
+def computePatchShifts(stack, tiltAngles, shifts, rotationAngle=0.0,
+                       sigma1=FILTER_SIGMA1, sigma2=FILTER_SIGMA2,
+                       radius2=FILTER_RADIUS2, transforms=None, views=None,
+                       patchSize=PATCH_SIZE, overlap=PATCH_OVERLAP, memoryLimit=None):
+    """Local shifts of overlapping patches of every view relative to the
+    previous one, left once the global shifts are applied. All the patches
+    of a view pair are correlated in a single batch of FFTs.
+
+    :param shifts: (N, 2) global shifts of computeNeighbourShifts.
+    :param memoryLimit: optional bytes the patches may take. The rows of
+        patches are then correlated in as many batches as needed.
+    Other parameters as in computeNeighbourShifts.
+    :return: (P, 2) (x, y) patch centers relative to the image center,
+        (N, P, 2) shifts that bring each patch onto the previous view in
+        addition to the global shift, and (N, P) normalized peak heights of
+        the patches. The first rows are zero.
+    """
+    nImages = len(tiltAngles)
+    views = list(range(nImages)) if views is None else list(views)
+    ny, nx = stack[views[0]].shape
+    patchSize = min(patchSize, ny, nx) // 2 * 2
+    rows, columns = patchGrid((ny, nx), patchSize, overlap)
+    centers = np.array([(x + (patchSize - nx) / 2, y + (patchSize - ny) / 2)
+                        for y in rows for x in columns])
+
+    window = taperWindow((patchSize, patchSize))
+    bandPass = bandPassFilter((patchSize, patchSize), sigma1, sigma2, radius2)
+    weights = _rfftWeights((patchSize, patchSize)) * bandPass
+    stretches = [(np.eye(2), False)] + list(_pairStretches(tiltAngles, rotationAngle))
+
+    patchShifts = np.zeros((nImages, len(centers), 2))
+    peakHeights = np.zeros((nImages, len(centers)))
+    rowsPerBatch = len(rows)
+    if memoryLimit:
+        # Patches, spectra and correlation maps of both views, besides the views
+        rowBytes = 32 * patchSize ** 2 * len(columns)
+        rowsPerBatch = int(max(1, min(len(rows), (memoryLimit - 16 * ny * nx) // rowBytes)))
+    for i in range(1, nImages):
+        stretch = np.eye(3)
+        stretch[0:2, 0:2], stretchPrevious = stretches[i]
+        previousMatrix = _viewMatrix(transforms, i - 1, stretch if stretchPrevious else None)
+        matrix = _viewMatrix(transforms, i, None if stretchPrevious else stretch)
+        # The global displacement, in the stretched frame, is undone first
+        translation = np.eye(3)
+        translation[0:2, 2] = stretches[i][0] @ shifts[i]
+        matrix = translation if matrix is None else translation @ matrix
+
+        previousView = _patchView(stack[views[i - 1]], previousMatrix)
+        view = _patchView(stack[views[i]], matrix)
+        for start in range(0, len(rows), rowsPerBatch):
+            batchRows = rows[start:start + rowsPerBatch]
+            batch = slice(start * len(columns), (start + len(batchRows)) * len(columns))
+            spectra = _rfft2(np.concatenate([
+                _viewPatches(previousView, batchRows, columns, patchSize, window),
+                _viewPatches(view, batchRows, columns, patchSize, window)]))
+            previousSpectra, pairSpectra = np.split(spectra, 2)
+            ccMaps = _irfft2(np.conj(previousSpectra) * pairSpectra * bandPass,
+                             (patchSize, patchSize))
+            displacements, peaks = _subPixelPeaks(ccMaps, patchSize // 4)
+
+            energies = (np.abs(spectra) ** 2 * weights).sum(axis=(1, 2))
+            nPatches = len(previousSpectra)
+            norms = np.sqrt(energies[:nPatches] * energies[nPatches:]) / patchSize ** 2
+            peakHeights[i, batch] = np.where(norms > 0, peaks / np.where(norms > 0, norms, 1), 0.0)
+            patchShifts[i, batch] = -np.linalg.solve(stretches[i][0], displacements.T).T
+
+    return centers, patchShifts, peakHeights
+
+
+def reusePairShifts(tiltAngles, transforms, previousAngles, previousShifts,
+                    previousTransforms):
+    """Reuse the shifts of a previous run on the same tilt-series for the view
+    pairs that have not changed, e.g. when new tilts have been acquired.
+
+    A pair is reused when the previous run had the same two tilt angles as
+    neighbours, with the same transforms.
+
+    :return: array with the reused shifts, or any other (M, ...) values of
+        the previous pairs, and the list of the indexes i of the (i - 1, i)
+        pairs that still have to be correlated.
+    """
+    def key(angle):
+        return round(float(angle), 2)
+
+    previousPairs = {}
+    for i in range(1, len(previousAngles)):
+        previousPairs[(key(previousAngles[i - 1]), key(previousAngles[i]))] = i
+
+    shifts = np.zeros((len(tiltAngles),) + np.shape(previousShifts)[1:])
+    pendingPairs = []
+    for i in range(1, len(tiltAngles)):
+        j = previousPairs.get((key(tiltAngles[i - 1]), key(tiltAngles[i])))
+        if j is not None and np.allclose(transforms[i - 1:i + 1], previousTransforms[j - 1:j + 1]):
+            shifts[i] = previousShifts[j]
+        else:
+            pendingPairs.append(i)
+    return shifts, pendingPairs
+
+
+def shiftResiduals(shifts, window=2):
+    """Deviation (pixels) of the shift of each view relative to the previous
+    one from the median of the shifts of the window pairs at each side, i.e.
+    how much a view jumps from the local drift. The first row is zero."""
+    residuals = np.zeros(len(shifts))
+    for i in range(1, len(shifts)):
+        neighbours = shifts[max(1, i - window):i + window + 1]
+        residuals[i] = np.linalg.norm(shifts[i] - np.median(neighbours, axis=0))
+    return residuals
+
+
+def findDarkViews(stack, fraction=DARK_VIEW_FRACTION, stride=STATS_STRIDE):
+    """Indexes of the empty or dark views of a stack, from the statistics of
+    a subsample of their pixels: views with non-finite values, without
+    contrast, or, for positive data such as counts, whose mean is below a
+    fraction of the median mean of the stack."""
+    means, deviations = np.empty(len(stack)), np.empty(len(stack))
+    for i in range(len(stack)):
+        sample = np.asarray(stack[i][::stride, ::stride], dtype=np.float64)
+        means[i], deviations[i] = sample.mean(), sample.std()
+
+    finite = np.isfinite(means) & np.isfinite(deviations)
+    if not finite.any():
+        return list(range(len(stack)))
+    medianMean = np.median(means[finite])
+    dark = ~finite | (deviations <= 1e-6 * np.median(deviations[finite]))
+    if medianMean > 0:
+        dark |= means < fraction * medianMean
+    return np.flatnonzero(dark).tolist()
+
+
+def bridgeMatrices(matrices, views, nImages):
+    """Transforms of the nImages views of a stack from the (M, 3, 3) matrices
+    of the aligned views, whose indexes are given. The transforms of the other
+    views are interpolated between the closest aligned views, or copied from
+    the closest one at the ends."""
+    flat = matrices.reshape(len(views), 9)
+    bridged = np.empty((nImages, 9))
+    for k in range(9):
+        bridged[:, k] = np.interp(np.arange(nImages), views, flat[:, k])
+    return bridged.reshape(nImages, 3, 3)
+
+
+def composeShifts(shifts, tiltAngles=None, rotationAngle=0.0):
+    """Compose relative shifts into global transforms whose average is the
+    unit transform, as xftoxg does for a global alignment.
+
+    When the tilt angles are given, the shifts are taken as measured between
+    cosine-stretched views (computeNeighbourShifts) and the error of
+    stretching about the image center instead of about the (unknown) view
+    position is removed: the position of each view follows from the previous
+    one by an affine recursion, solved so that the mean position is zero.
+
+    :return: (N, 3, 3) array of homogeneous transformation matrices.
+    """
+    if tiltAngles is None:
+        cumulative = np.cumsum(shifts, axis=0)
+        cumulative -= cumulative.mean(axis=0)
+        return shiftsToMatrices(cumulative)
+
+    # Position of view i as M[i] @ position0 + c[i]
+    nImages = len(shifts)
+    M = np.tile(np.eye(2), (nImages, 1, 1))
+    c = np.zeros((nImages, 2))
+    for i, (stretch, stretchPrevious) in enumerate(_pairStretches(tiltAngles, rotationAngle), 1):
+        if stretchPrevious:
+            M[i] = stretch @ M[i - 1]
+            c[i] = stretch @ (c[i - 1] - shifts[i])
+        else:
+            inverse = np.linalg.inv(stretch)
+            M[i] = inverse @ M[i - 1]
+            c[i] = inverse @ c[i - 1] - shifts[i]
+    position0 = np.linalg.solve(M.mean(axis=0), -c.mean(axis=0))
+    positions = M @ position0 + c
+    return shiftsToMatrices(-positions)
+
+
+def shiftsToMatrices(shifts):
+    """Homogeneous (N, 3, 3) matrices of pure (x, y) shifts."""
+    matrices = np.tile(np.eye(3), (len(shifts), 1, 1))
+    matrices[:, 0:2, 2] = shifts
+    return matrices
+
+
+def binImage(image, binning):
+    """Bin an image by averaging binning x binning pixel blocks. Pixels that
+    do not fill a whole block at the borders are dropped."""
+    if binning <= 1:
+        return image
+    ny, nx = image.shape[0] // binning, image.shape[1] // binning
+    blocks = image[:ny * binning, :nx * binning].reshape(ny, binning, nx, binning)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def alignView(view, matrix, binning=1):
+    """Apply a transformation matrix to a view and bin it. Areas coming from
+    outside the view are filled with its mean."""
+    view = np.asarray(view, dtype=np.float32)
+    return binImage(affineResample(view, matrix, fill=view.mean()), binning)
+
+
+def writeAlignedStack(inputFileName, outputFileName, matrices, binning=1, views=None,
+                      dtype=np.float32):
+    """Apply the (N, 3, 3) transformation matrices to the views of an MRC
+    stack and bin them, as newstack -xform -bin does. The stack is processed
+    one view at a time through memory maps so memory stays bounded to a few
+    slices whatever the stack size.
+
+    :param views: indexes of the views to write, all of them by default.
+    :param dtype: data type of the output, float32 or an integer type. Integer
+        values are scaled to the range of the input stack (see
+        intensityScaling).
+    :return: the (scale, offset) of an integer output, None for float32.
+    """
+    with mrcfile.mmap(inputFileName, mode='r', permissive=True) as inputMrc:
+        nImages, ny, nx = inputMrc.data.shape
+        views = list(range(nImages)) if views is None else list(views)
+        voxelSize = inputMrc.voxel_size
+        scaling = intensityScaling(inputMrc, dtype)
+        _writeViews(outputFileName, (len(views), ny // binning, nx // binning),
+                    (alignView(inputMrc.data[i], matrices[i], binning) for i in views),
+                    (voxelSize.x * binning, voxelSize.y * binning, voxelSize.z),
+                    dtype, scaling)
+    return scaling
+
+
+def intensityScaling(mrc, dtype, stride=STATS_STRIDE):
+    """(scale, offset) to store the values of an open MRC stack, or of views
+    resampled from it, as integers of dtype: value = stored * scale + offset.
+    The range is taken from the header, or from every stride-th row and column
+    of the views when the header has none. None for float types."""
+    if not np.issubdtype(dtype, np.integer):
+        return None
+    minimum, maximum = float(mrc.header.dmin), float(mrc.header.dmax)
+    if not maximum > minimum:
+        sample = mrc.data[..., ::stride, ::stride]
+        minimum, maximum = float(sample.min()), float(sample.max())
+    scale = (maximum - minimum) / (2 * np.iinfo(dtype).max)
+    return scale if scale > 0 else 1.0, (maximum + minimum) / 2
+
+
+def readIntensityScaling(fileName):
+    """(scale, offset) recorded in an integer MRC stack, None if there are none."""
+    try:
+        with mrcfile.open(fileName, header_only=True, permissive=True) as mrc:
+            labels = mrc.get_labels()
+    except (OSError, ValueError):
+        return None
+    for label in labels:
+        words = label.split()
+        if label.startswith(SCALING_LABEL.split(' %')[0]) and len(words) == 5:
+            return float(words[2]), float(words[4])
+    return None
+
+
+def writeTransformedStack(locations, outputFileName, matrices=None):
+    """Write the views at the (index, fileName) locations (indexes from 1) in
+    a new MRC stack, transformed by the (N, 3, 3) matrices if given. Views are
+    read and written one at a time through memory maps.
+    """
+    def transformedViews(mrcFiles):
+        for n, (index, fileName) in enumerate(locations):
+            if fileName not in mrcFiles:
+                # Only the file being read is kept open
+                for mrc in mrcFiles.values():
+                    mrc.close()
+                mrcFiles.clear()
+                mrcFiles[fileName] = mrcfile.mmap(fileName, mode='r', permissive=True)
+            data = mrcFiles[fileName].data
+            view = data[index - 1] if data.ndim == 3 else data
+            if matrices is None or isIdentity(matrices[n]):
+                yield np.asarray(view, dtype=np.float32)
+            else:
+                yield alignView(view, matrices[n])
+
+    with mrcfile.mmap(locations[0][1], mode='r', permissive=True) as mrc:
+        shape = (len(locations),) + mrc.data.shape[-2:]
+        voxelSize = mrc.voxel_size
+    mrcFiles = {}
+    try:
+        _writeViews(outputFileName, shape, transformedViews(mrcFiles),
+                    (voxelSize.x, voxelSize.y, voxelSize.z))
+    finally:
+        for mrc in mrcFiles.values():
+            mrc.close()
+
+
+def _writeViews(outputFileName, shape, views, voxelSize, dtype=np.float32, scaling=None):
+    """Write the 2D arrays of the views iterable in a new MRC stack of the
+    given shape, one at a time. Integer stacks store the values with the
+    (scale, offset) scaling and record it in a header label."""
+    dtype = np.dtype(dtype)
+    with mrcfile.new_mmap(outputFileName, shape=shape, overwrite=True,
+                          mrc_mode=mrcfile.utils.mode_from_dtype(dtype)) as outputMrc:
+        if scaling is not None:
+            limit = np.iinfo(dtype).max
+            outputMrc.add_label(SCALING_LABEL % scaling)
+        minimum, maximum, total = np.inf, -np.inf, 0.0
+        for n, view in enumerate(views):
+            if scaling is not None:
+                view = np.clip(np.rint((view - scaling[1]) / scaling[0]), -limit, limit)
+            outputMrc.data[n] = view
+            # Header statistics gathered on the fly instead of re-reading the stack
+            minimum = min(minimum, view.min())
+            maximum = max(maximum, view.max())
+            total += view.sum(dtype=np.float64)
+        outputMrc.voxel_size = voxelSize
+        outputMrc.header.dmin = minimum
+        outputMrc.header.dmax = maximum
+        outputMrc.header.dmean = total / np.prod(shape)
+
+
+def isCompleteStack(fileName, nImages):
+    """Whether fileName is an MRC stack of nImages views and the file holds
+    all the data its header announces."""
+    try:
+        with mrcfile.open(fileName, header_only=True, permissive=True) as mrc:
+            header = mrc.header
+            dtype = mrcfile.utils.data_dtype_from_header(header)
+            dataSize = int(header.nx) * int(header.ny) * int(header.nz) * dtype.itemsize
+            return int(header.nz) == nImages and \
+                os.path.getsize(fileName) >= header.nbytes + int(header.nsymbt) + dataSize
+    except (OSError, ValueError):
+        return False
+
+
+class VirtualAlignedStack:
+    """Aligned and binned views of an MRC stack computed only when accessed.
+
+    It behaves as a read-only sequence of 2D arrays. The most recently used
+    views are kept in memory, up to cacheSize of them.
+    """
+
+    def __init__(self, fileName, matrices, binning=1, cacheSize=8):
+        self._mrc = mrcfile.mmap(fileName, mode='r', permissive=True)
+        self._matrices = matrices
+        self._binning = binning
+        self._cacheSize = cacheSize
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._matrices)
+
+    def __getitem__(self, index):
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+
+        aligned = alignView(self._mrc.data[index], self._matrices[index], self._binning)
+        self._cache[index] = aligned
+        if len(self._cache) > self._cacheSize:
+            self._cache.popitem(last=False)
+        return aligned
+
+    def close(self):
+        self._mrc.close()
+        self._cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def isIdentity(matrices):
+    """Whether all the given transformation matrices are the unit transform."""
+    return np.allclose(matrices, np.eye(matrices.shape[-1]))
+
+
+def readXfFile(fileName):
+    """Read an IMOD .xf file as (N, 3, 3) transformation matrices."""
+    values = np.loadtxt(fileName, ndmin=2)
+    matrices = np.tile(np.eye(3), (len(values), 1, 1))
+    matrices[:, 0, 0:2] = values[:, 0:2]
+    matrices[:, 1, 0:2] = values[:, 2:4]
+    matrices[:, 0:2, 2] = values[:, 4:6]
+    return matrices
+
+
+def writeXfFile(matrices, fileName):
+    """Write (N, 3, 3) transformation matrices in the IMOD .xf format."""
+    with open(fileName, 'w') as f:
+        for m in matrices:
+            f.write("%12.7f%12.7f%12.7f%12.7f%12.3f%12.3f\n"
+                    % (m[0, 0], m[0, 1], m[1, 0], m[1, 1], m[0, 2], m[1, 2]))
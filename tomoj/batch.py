@@ -0,0 +1,187 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Prealignment of a batch of tilt-series outside a Scipion project, with the
+same pipeline as the protocol. Every MRC stack needs a tilt angles file with
+the same name and the .rawtlt extension. The transforms (<tsId>.prexg) and
+the aligned stacks (<tsId>_preali.st), with the tilt angles of their views
+(<tsId>_preali.tlt), are written to the output folder:
+
+    tomoj_prealign 'data/*.st' --output prealigned --bin 2 --workers 4
+
+Tilt-series whose .prexg is already in the output folder are skipped, so an
+interrupted batch can be run again. Within a Slurm job array, every task
+takes its share of the stacks.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from tomoj import alignment, pipeline
+from tomoj.constants import OUTPUT_MODES
+
+STACK_EXTENSIONS = ['.st', '.mrc', '.mrcs']
+TILTS_EXTENSION = '.rawtlt'
+
+
+def findStacks(inputs):
+    """MRC stacks of the given folders, glob patterns or files, sorted and
+    without duplicates."""
+    stacks = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*')
+        for fileName in glob.glob(pattern):
+            if os.path.isfile(fileName) and \
+                    os.path.splitext(fileName)[1].lower() in STACK_EXTENSIONS:
+                stacks.add(os.path.abspath(fileName))
+    return sorted(stacks)
+
+
+def taskStacks(stacks, task, tasks):
+    """Stacks processed by one of the tasks of a job array."""
+    return stacks[task::tasks]
+
+
+def prealignStack(stackFileName, outputDir, rotationAngle=0.0, pyramidLevels=1,
+                  pairWorkers=1, excludeDark=False, binning=1, mode=OUTPUT_MODES[0],
+                  interpolate=True, writeQuality=False, memoryLimit=None):
+    """Align a stack with its .rawtlt tilt angles and write <tsId>.prexg, and
+    <tsId>_preali.st if interpolate, to outputDir. The .prexg has a line per
+    view of the stack, while the aligned stack leaves out the excluded views:
+    the tilt angles of its views are written to <tsId>_preali.tlt. The .prexg
+    is written last and marks the tilt-series as done. Return the alignment
+    score."""
+    tsId = os.path.splitext(os.path.basename(stackFileName))[0]
+    tiltAngles = pipeline.readTiltFile(os.path.splitext(stackFileName)[0] + TILTS_EXTENSION)
+    prefix = os.path.join(outputDir, tsId)
+    qualityFileName = prefix + '_quality.npy'
+
+    views = pipeline.selectViews(stackFileName, excludeDark=excludeDark)
+    matrices = pipeline.alignStack(stackFileName, tiltAngles,
+                                   rotationAngle=rotationAngle, pyramidLevels=pyramidLevels,
+                                   workers=pairWorkers, views=views,
+                                   qualityFileName=qualityFileName, memoryLimit=memoryLimit)
+    if interpolate:
+        np.savetxt(prefix + '_preali.tlt', np.asarray(tiltAngles)[views], fmt='%.2f')
+        # Written aside and renamed, so that an existing stack is a complete one
+        partialFileName = prefix + '_preali.st.part'
+        pipeline.interpolateStack(stackFileName, matrices, partialFileName, binning=binning,
+                                  views=views, mode=mode)
+        os.replace(partialFileName, prefix + '_preali.st')
+    alignment.writeXfFile(matrices, prefix + '.prexg.part')
+    os.replace(prefix + '.prexg.part', prefix + '.prexg')
+
+    score = pipeline.alignmentScore(np.load(qualityFileName))
+    if not writeQuality:
+        os.remove(qualityFileName)
+    return score
+
+
+def isDone(stackFileName, outputDir):
+    """Whether the stack was completely prealigned by a previous run."""
+    tsId = os.path.splitext(os.path.basename(stackFileName))[0]
+    return os.path.exists(os.path.join(outputDir, tsId + '.prexg'))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='TomoJ prealignment of a batch of tilt-series.')
+    parser.add_argument('inputs', nargs='+',
+                        help='Folders, glob patterns or MRC stacks. Each stack needs '
+                             'a %s file with its tilt angles' % TILTS_EXTENSION)
+    parser.add_argument('--output', default='.', help='Output folder')
+    parser.add_argument('--rotation-angle', type=float, default=0.0,
+                        help='Tilt axis angle from the vertical (degrees)')
+    parser.add_argument('--pyramid-levels', type=int, default=1)
+    parser.add_argument('--exclude-dark', action='store_true',
+                        help='Do not align the dark or empty views')
+    parser.add_argument('--bin', type=int, default=1,
+                        help='Binning of the aligned stacks')
+    parser.add_argument('--mode', choices=OUTPUT_MODES, default=OUTPUT_MODES[0],
+                        help='Data type of the aligned stacks')
+    parser.add_argument('--no-interpolation', action='store_true',
+                        help='Only write the transforms')
+    parser.add_argument('--quality', action='store_true',
+                        help='Also write the alignment quality of the views '
+                             '(<tsId>_quality.npy)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Tilt-series processed at the same time')
+    parser.add_argument('--pair-workers', type=int, default=1,
+                        help='Processes to correlate the view pairs of each tilt-series')
+    parser.add_argument('--memory', type=float,
+                        help='Memory the correlation of each tilt-series may take (GB)')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Process again the tilt-series already done')
+    parser.add_argument('--task', type=int,
+                        default=int(os.environ.get('SLURM_ARRAY_TASK_ID', 0)) -
+                        int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0)),
+                        help='Index of this task in a job array, from the Slurm '
+                             'environment by default')
+    parser.add_argument('--tasks', type=int,
+                        default=int(os.environ.get('SLURM_ARRAY_TASK_COUNT', 1)),
+                        help='Tasks of the job array')
+    args = parser.parse_args(args)
+
+    stacks = taskStacks(findStacks(args.inputs), args.task, args.tasks)
+    if not args.overwrite:
+        stacks = [stack for stack in stacks if not isDone(stack, args.output)]
+    os.makedirs(args.output, exist_ok=True)
+    print('%d tilt-series to prealign' % len(stacks))
+
+    kwargs = {'rotationAngle': args.rotation_angle, 'pyramidLevels': args.pyramid_levels,
+              'pairWorkers': args.pair_workers, 'excludeDark': args.exclude_dark,
+              'binning': args.bin, 'mode': args.mode,
+              'interpolate': not args.no_interpolation, 'writeQuality': args.quality,
+              'memoryLimit': args.memory * 1024 ** 3 if args.memory else None}
+    failed = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {executor.submit(prealignStack, stack, args.output, **kwargs): stack
+                   for stack in stacks}
+        for future in as_completed(futures):
+            stack = futures[future]
+            try:
+                print('%s: alignment score %.3f' % (stack, future.result()))
+            except Exception as e:
+                print('%s: failed, %s' % (stack, e), file=sys.stderr)
+                failed.append(stack)
+            sys.stdout.flush()
+
+    print('%d tilt-series prealigned in %.1f s'
+          % (len(stacks) - len(failed), time.perf_counter() - start))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,325 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Benchmark of the xcorr prealignment pipeline on synthetic tilt-series.
+
+A random specimen is foreshortened by the cosine of each tilt angle, shifted
+by a known amount and corrupted with gaussian noise. Each stage of the
+pipeline (IMOD newstack as well when it is installed) is then run and measured
+(wall and CPU time, peak RSS of the stage, bytes read and written) and the
+recovered transforms are compared with the ground truth.
+The time to import the protocols of the plugin is also measured when Scipion
+is installed, since every plugin is imported to build the protocol lists.
+
+Usage:
+    scipion python -m tomoj.benchmark --size 1024 --tilts 61 --output bench.json
+    scipion python -m tomoj.benchmark --import-only --import-budget 0.05
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from importlib.util import find_spec
+
+import mrcfile
+import numpy as np
+
+from tomoj import alignment
+
+# Modules that Scipion has already imported before loading the plugin protocols
+IMPORT_BASELINE = ['pwem.protocols', 'tomo.protocols']
+# Modules the protocols must not import until a step runs
+LAZY_IMPORTS = ['numpy', 'mrcfile', 'tomoj.alignment', 'tomoj.pipeline', 'tomoj.cache']
+
+
+def _ioCounters():
+    """Bytes read and written by this process, from /proc when available."""
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                counters[name] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+
+def _maxRss(who):
+    """ru_maxrss of getrusage(who), in bytes."""
+    peak = resource.getrusage(who).ru_maxrss
+    return peak * 1024 if sys.platform != 'darwin' else peak
+
+
+def _resetPeakRss():
+    """Reset the peak resident set size of this process (VmHWM) to the
+    current one, so that the peak of a stage is not that of a previous one.
+    False when the kernel does not allow it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        with open('/proc/self/status') as f:
+            return any(line.startswith('VmHWM:') for line in f)
+    except OSError:
+        return False
+
+
+def _peakRssSinceReset():
+    """VmHWM of this process, in bytes."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+
+
+@contextmanager
+def measure(results, stage):
+    """Record the resources used by the block as results[stage]. peakRss is
+    the peak of the block itself where /proc allows resetting it
+    (peakRssOfStage), the peak of the whole process until then otherwise.
+    Children that reached a new peak during the block are accounted too."""
+    reset = _resetPeakRss()
+    childrenPeak0 = _maxRss(resource.RUSAGE_CHILDREN)
+    read0, written0 = _ioCounters()
+    cpu0 = time.process_time()
+    wall0 = time.perf_counter()
+    yield
+    read1, written1 = _ioCounters()
+    peakRss = _peakRssSinceReset() if reset else _maxRss(resource.RUSAGE_SELF)
+    childrenPeak = _maxRss(resource.RUSAGE_CHILDREN)
+    if childrenPeak > childrenPeak0:
+        peakRss = max(peakRss, childrenPeak)
+    results[stage] = {'wallTime': time.perf_counter() - wall0,
+                      'cpuTime': time.process_time() - cpu0,
+                      'peakRss': peakRss,
+                      'peakRssOfStage': reset,
+                      'bytesRead': read1 - read0,
+                      'bytesWritten': written1 - written0}
+
+
+def measureImport(module='tomoj.protocols', baseline=IMPORT_BASELINE):
+    """Time to import module in a new interpreter where the baseline modules
+    are already imported, and the modules it imports in addition to them.
+    None if the baseline modules are not installed."""
+    if any(find_spec(name.split('.')[0]) is None for name in baseline):
+        return None
+    code = ("import importlib, sys, time\n"
+            "for name in %r: importlib.import_module(name)\n"
+            "loaded = set(sys.modules)\n"
+            "start = time.perf_counter()\n"
+            "importlib.import_module(%r)\n"
+            "print(time.perf_counter() - start)\n"
+            "print(' '.join(sorted(set(sys.modules) - loaded)))") % (list(baseline), module)
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     universal_newlines=True).splitlines()
+    imported = output[1].split() if len(output) > 1 else []
+    return {'importTime': float(output[0]),
+            'importedModules': imported,
+            'heavyImports': [name for name in LAZY_IMPORTS if name in imported]}
+
+
+def syntheticTiltSeries(size=512, nTilts=41, tiltRange=60.0, noise=0.5,
+                        maxShift=20.0, rotationAngle=0.0, seed=0):
+    """Synthetic tilt-series with known shifts.
+
+    :return: (stack, tiltAngles, shifts) where stack is a (N, size, size)
+        float32 array and shifts the (N, 2) true (x, y) displacement of each view.
+    """
+    rng = np.random.default_rng(seed)
+    freqY = np.fft.fftfreq(size)[:, None]
+    freqX = np.fft.rfftfreq(size)[None, :]
+    lowPass = np.exp(-(freqX ** 2 + freqY ** 2) / (2 * 0.04 ** 2))
+    specimen = np.fft.irfft2(np.fft.rfft2(rng.normal(size=(size, size))) * lowPass,
+                             s=(size, size)).astype(np.float32)
+    specimen /= specimen.std()
+
+    tiltAngles = np.linspace(-tiltRange, tiltRange, nTilts)
+    shifts = rng.uniform(-maxShift, maxShift, (nTilts, 2))
+    stack = np.empty((nTilts, size, size), dtype=np.float32)
+    for i, angle in enumerate(tiltAngles):
+        matrix = np.eye(3)
+        matrix[0:2, 0:2] = alignment.stretchMatrix(np.cos(np.deg2rad(angle)), rotationAngle)
+        matrix[0:2, 2] = shifts[i]
+        stack[i] = alignment.affineResample(specimen, matrix)
+        stack[i] += rng.normal(scale=noise, size=(size, size))
+    return stack, tiltAngles, shifts
+
+
+def alignmentError(matrices, shifts):
+    """RMS and maximum distance (pixels) between the recovered and true
+    alignment, once the arbitrary global offset is removed."""
+    residuals = matrices[:, 0:2, 2] + shifts
+    residuals -= residuals.mean(axis=0)
+    distances = np.linalg.norm(residuals, axis=1)
+    return {'rms': float(np.sqrt((distances ** 2).mean())),
+            'max': float(distances.max())}
+
+
+def runBenchmark(workDir, size=512, nTilts=41, tiltRange=60.0, noise=0.5,
+                 maxShift=20.0, rotationAngle=0.0, binning=2, seed=0,
+                 pyramidLevels=1):
+    """Run every stage of the pipeline in workDir and return the report."""
+    stages = {}
+    stack, tiltAngles, shifts = syntheticTiltSeries(size, nTilts, tiltRange, noise,
+                                                    maxShift, rotationAngle, seed)
+    inputFileName = os.path.join(workDir, 'bench_input.st')
+    stackFileName = os.path.join(workDir, 'bench.st')
+    prexfFileName = os.path.join(workDir, 'bench.prexf')
+    prexgFileName = os.path.join(workDir, 'bench.prexg')
+
+    with mrcfile.new(inputFileName, data=stack, overwrite=True) as mrc:
+        mrc.voxel_size = 1.0
+    del stack
+
+    # As the protocol converts tilt-images that are not a single ordered stack
+    with measure(stages, 'convert'):
+        alignment.writeTransformedStack([(index + 1, inputFileName)
+                                         for index in range(nTilts)], stackFileName)
+        np.savetxt(os.path.join(workDir, 'bench.rawtlt'), tiltAngles, fmt='%.2f')
+    os.remove(inputFileName)
+
+    with measure(stages, 'xcorr'):
+        with mrcfile.mmap(stackFileName, mode='r') as mrc:
+            neighbourShifts = alignment.computeNeighbourShifts(mrc.data, tiltAngles,
+                                                               rotationAngle=rotationAngle,
+                                                               pyramidLevels=pyramidLevels)
+        alignment.writeXfFile(alignment.shiftsToMatrices(neighbourShifts), prexfFileName)
+
+    with measure(stages, 'xftoxg'):
+        matrices = alignment.composeShifts(neighbourShifts, tiltAngles, rotationAngle)
+        alignment.writeXfFile(matrices, prexgFileName)
+
+    with measure(stages, 'interpolate'):
+        alignment.writeAlignedStack(stackFileName, os.path.join(workDir, 'bench_preali.st'),
+                                    matrices, binning)
+
+    if shutil.which('newstack'):
+        with measure(stages, 'newstack'):
+            subprocess.check_call(['newstack', '-input', stackFileName,
+                                   '-output', os.path.join(workDir, 'bench_newstack.st'),
+                                   '-xform', prexgFileName, '-bin', str(binning)],
+                                  stdout=subprocess.DEVNULL)
+
+    try:
+        import tomo.objects as tomoObj
+    except ImportError:
+        tomoObj = None
+    if tomoObj is not None:
+        with measure(stages, 'setWriting'):
+            _writeSetOfTiltSeries(tomoObj, os.path.join(workDir, 'bench.sqlite'),
+                                  stackFileName, tiltAngles, matrices)
+
+    return {'parameters': {'size': size, 'nTilts': nTilts, 'tiltRange': tiltRange,
+                           'noise': noise, 'maxShift': maxShift,
+                           'rotationAngle': rotationAngle, 'binning': binning,
+                           'seed': seed, 'pyramidLevels': pyramidLevels},
+            'stages': stages,
+            'alignmentError': alignmentError(matrices, shifts)}
+
+
+def _writeSetOfTiltSeries(tomoObj, fileName, stackFileName, tiltAngles, matrices):
+    import pwem.objects as data
+    outputSet = tomoObj.SetOfTiltSeries(filename=fileName)
+    outputSet.setSamplingRate(1.0)
+    ts = tomoObj.TiltSeries(tsId='bench')
+    outputSet.append(ts)
+    for index, angle in enumerate(tiltAngles):
+        ti = tomoObj.TiltImage(location=(index + 1, stackFileName))
+        ti.setTiltAngle(angle)
+        transform = data.Transform()
+        transform.setMatrix(matrices[index])
+        ti.setTransform(transform)
+        ts.append(ti)
+    ts.write()
+    outputSet.update(ts)
+    outputSet.write()
+    outputSet.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--size', type=int, default=512, help='Image size in pixels')
+    parser.add_argument('--tilts', type=int, default=41, help='Number of tilts')
+    parser.add_argument('--tilt-range', type=float, default=60.0,
+                        help='Maximum absolute tilt angle (degrees)')
+    parser.add_argument('--noise', type=float, default=0.5,
+                        help='Noise standard deviation relative to the signal')
+    parser.add_argument('--max-shift', type=float, default=20.0,
+                        help='Maximum random shift in pixels')
+    parser.add_argument('--rotation-angle', type=float, default=0.0,
+                        help='Tilt axis angle from the vertical (degrees)')
+    parser.add_argument('--binning', type=int, default=2)
+    parser.add_argument('--pyramid-levels', type=int, default=1,
+                        help='Resolution levels of the coarse-to-fine correlation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='Folder for the intermediate files, '
+                                          'a temporary one by default')
+    parser.add_argument('--output', help='JSON report file, stdout by default')
+    parser.add_argument('--import-only', action='store_true',
+                        help='Only measure the import of the plugin protocols')
+    parser.add_argument('--import-budget', type=float,
+                        help='Fail if importing the plugin protocols takes longer '
+                             '(seconds) or imports the heavy modules')
+    args = parser.parse_args(args)
+
+    report = {}
+    if not args.import_only:
+        workDir = args.workdir or tempfile.mkdtemp(prefix='tomoj_bench_')
+        os.makedirs(workDir, exist_ok=True)
+        try:
+            report = runBenchmark(workDir, args.size, args.tilts, args.tilt_range,
+                                  args.noise, args.max_shift, args.rotation_angle,
+                                  args.binning, args.seed, args.pyramid_levels)
+        finally:
+            if not args.workdir:
+                shutil.rmtree(workDir, ignore_errors=True)
+    report['import'] = measureImport()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.import_budget is not None and report['import'] is not None and \
+            (report['import']['importTime'] > args.import_budget or
+             report['import']['heavyImports']):
+        sys.exit('Importing the protocols took %.3f s (budget %.3f s) and imported: %s'
+                 % (report['import']['importTime'], args.import_budget,
+                    ', '.join(report['import']['heavyImports']) or 'no heavy modules'))
+
+
+if __name__ == '__main__':
+    main()
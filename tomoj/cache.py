@@ -0,0 +1,106 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Content-addressed cache of cross-correlation results (.prexf/.prexg files).
+
+Each entry is a folder named after the hash of everything the result depends
+on. Entries are touched when used and the least recently used ones are evicted
+when the cache grows beyond its maximum size.
+"""
+
+import hashlib
+import os
+import shutil
+
+import numpy as np
+
+
+def stackSignature(fileNames):
+    """Cheap identity of a set of image files: real path, size and mtime."""
+    signature = []
+    for fileName in sorted(set(fileNames)):
+        stat = os.stat(fileName)
+        signature.append((os.path.realpath(fileName), stat.st_size, stat.st_mtime_ns))
+    return signature
+
+
+def cacheKey(*items):
+    """Hash of the given items. Numpy arrays are hashed by value."""
+    sha = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            sha.update(np.ascontiguousarray(item, dtype=np.float64).round(6).tobytes())
+        else:
+            sha.update(repr(item).encode())
+    return sha.hexdigest()
+
+
+def fetch(cacheDir, key, fileNames):
+    """Copy the cached files of key to fileNames. Return False on a miss."""
+    entry = os.path.join(cacheDir, key)
+    cachedFiles = [os.path.join(entry, os.path.basename(f)) for f in fileNames]
+    if not all(os.path.exists(f) for f in cachedFiles):
+        return False
+    for cachedFile, fileName in zip(cachedFiles, fileNames):
+        shutil.copyfile(cachedFile, fileName)
+    os.utime(entry)
+    return True
+
+
+def store(cacheDir, key, fileNames, maxSize):
+    """Add fileNames to the cache as the entry of key and evict the least
+    recently used entries beyond maxSize bytes."""
+    entry = os.path.join(cacheDir, key)
+    # Written aside and renamed so concurrent readers never see partial entries
+    tmpEntry = '%s.%d.tmp' % (entry, os.getpid())
+    os.makedirs(tmpEntry, exist_ok=True)
+    for fileName in fileNames:
+        shutil.copyfile(fileName, os.path.join(tmpEntry, os.path.basename(fileName)))
+    try:
+        os.rename(tmpEntry, entry)
+    except OSError:
+        # Another process stored the same entry meanwhile
+        shutil.rmtree(tmpEntry, ignore_errors=True)
+    evict(cacheDir, maxSize)
+
+
+def evict(cacheDir, maxSize):
+    """Remove the least recently used entries until the cache fits in maxSize bytes."""
+    entries = []
+    for name in os.listdir(cacheDir):
+        entry = os.path.join(cacheDir, name)
+        if not os.path.isdir(entry) or name.endswith('.tmp'):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        entries.append((os.path.getmtime(entry), size, entry))
+
+    totalSize = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if totalSize <= maxSize:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        totalSize -= size
@@ -28,3 +28,41 @@
 # ----------------- Constants values --------------------------------------
 
 TOMOJ_HOME = 'TOMOJ_HOME'
+
+# Node-local folder for the temporary files of the tilt-series, the project
+# tmp folder is used when it is empty
+TOMOJ_SCRATCH = 'TOMOJ_SCRATCH'
+
+# Cache of cross-correlation results, disabled when the folder is empty
+TOMOJ_CACHE = 'TOMOJ_CACHE'
+TOMOJ_CACHE_SIZE = 'TOMOJ_CACHE_SIZE'  # GB
+
+# Extensions of the MRC files that are read directly
+MRC_EXTENSIONS = ['.mrc', '.mrcs', '.st', '.ali']
+
+# Data types of the interpolated stacks, in the order of the protocol choices.
+# Integer stacks record the scaling of their values in an MRC header label
+OUTPUT_MODES = ['float32', 'int16', 'int8']
+
+# Cross-correlation engines
+XCORR_ENGINE_TOMOJ = 0
+XCORR_ENGINE_IMOD = 1
+
+# Band-pass filter applied to the cross-correlation (cycles/pixel), same values
+# passed to tiltxcorr
+FILTER_SIGMA1 = 0.03
+FILTER_SIGMA2 = 0.05
+FILTER_RADIUS2 = 0.25
+
+# Views whose mean is below this fraction of the median mean of the tilt-series
+# are taken as dark
+DARK_VIEW_FRACTION = 0.2
+
+# Local shifts: side of the square patches (pixels) and their overlap fraction
+PATCH_SIZE = 256
+PATCH_OVERLAP = 0.5
+
+# Output sets are committed and the protocol stored every OUTPUT_FLUSH_SERIES
+# tilt-series or OUTPUT_FLUSH_SECONDS seconds, whatever comes first
+OUTPUT_FLUSH_SERIES = 20
+OUTPUT_FLUSH_SECONDS = 60
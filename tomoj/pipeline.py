@@ -0,0 +1,335 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+File level steps of the TomoJ prealignment of a tilt-series, shared by the
+protocol and by the command line:
+
+    python -m tomoj.pipeline xcorr --input TS.st --tilts TS.rawtlt \
+        --matrices TS_prexg.npy --prexg TS.prexg
+    python -m tomoj.pipeline interpolate --input TS.st --xform TS_prexg.npy \
+        --output TS_preali.st --bin 2
+    python -m tomoj.pipeline convert --images TS_images.txt --xform TS_input.npy \
+        --output TS.st
+
+The protocol runs them as external programs when MPI is used, so that the
+MPI executor distributes the tilt-series over the MPI nodes. With --scratch,
+placed before the command, the stacks are processed in the node-local scratch
+folder: the input stack is copied in and the outputs are written there and
+moved to their destinations at the end.
+"""
+
+import argparse
+import os
+import sys
+
+import mrcfile
+import numpy as np
+
+from tomoj import alignment, scratch
+from tomoj.constants import (FILTER_SIGMA1, FILTER_SIGMA2, FILTER_RADIUS2,
+                             PATCH_SIZE, PATCH_OVERLAP, OUTPUT_MODES)
+
+# Columns of the per-view alignment quality
+QUALITY_FIELDS = ['peakHeight', 'peakToNoise', 'residualShift']
+
+
+def alignStack(stackFileName, tiltAngles, matricesFileName=None,
+               prexfFileName=None, prexgFileName=None, inputMatricesFileName=None,
+               stateFileName=None, rotationAngle=0.0, pyramidLevels=1, workers=1,
+               views=None, qualityFileName=None, patchesFileName=None,
+               patchSize=PATCH_SIZE, patchOverlap=PATCH_OVERLAP, memoryLimit=None,
+               cpuTimes=None):
+    """Cross-correlate the neighbouring views of a stack and return the
+    (N, 3, 3) global transformation matrices that align them.
+
+    :param matricesFileName: optional .npy file to save the global matrices.
+    :param prexfFileName, prexgFileName: optional IMOD files to write the
+        relative and global transformations.
+    :param inputMatricesFileName: optional .npy or .xf file with transforms to
+        apply to the views before correlating. They are composed into the
+        global matrices.
+    :param stateFileName: optional .npz file where the neighbour shifts are
+        kept, so that a new run on a stack with more views only correlates
+        the new view pairs.
+    :param workers: number of processes to correlate the view pairs.
+    :param views: indexes of the views to align, all of them by default. The
+        transforms of the other views are bridged from their neighbours.
+    :param qualityFileName: optional .npy file to save the (N, 3) alignment
+        quality of every view relative to the previous aligned one, with the
+        QUALITY_FIELDS columns. Zero for the first and the skipped views.
+    :param patchesFileName: optional .npz file to save the local shifts of
+        overlapping patches of patchSize pixels left after the global
+        alignment (see alignment.computePatchShifts): 'centers', 'shifts' and
+        'peaks' arrays, zero for the first and the skipped views.
+    :param memoryLimit: optional bytes the correlation may take. The workers
+        and the view pairs per FFT batch are reduced to fit within it.
+    :param cpuTimes: optional list where the CPU time of every worker process
+        is appended.
+    """
+    nImages = len(tiltAngles)
+    views = list(range(nImages)) if views is None else list(views)
+    if not views:
+        raise ValueError("There are no views to align in %s" % stackFileName)
+    tiltAngles = [tiltAngles[i] for i in views]
+    inputMatrices = readMatrices(inputMatricesFileName)[views] \
+        if inputMatricesFileName and os.path.exists(inputMatricesFileName) else None
+    viewTransforms = inputMatrices if inputMatrices is not None \
+        else np.tile(np.eye(3), (len(tiltAngles), 1, 1))
+    parameters = np.array([rotationAngle, FILTER_SIGMA1, FILTER_SIGMA2,
+                           FILTER_RADIUS2, pyramidLevels])
+    shifts, peaks, pairs = _loadState(stateFileName, tiltAngles, viewTransforms, parameters)
+
+    if pairs:
+        pairsPerBatch = alignment.PAIRS_PER_BATCH
+        if memoryLimit:
+            workers, pairsPerBatch = fitMemory(stackFileName, memoryLimit, workers,
+                                               pyramidLevels)
+        pairShifts, pairPeaks = alignment.computeNeighbourShiftsParallel(
+            stackFileName, tiltAngles, workers, pairs=pairs, rotationAngle=rotationAngle,
+            sigma1=FILTER_SIGMA1, sigma2=FILTER_SIGMA2, radius2=FILTER_RADIUS2,
+            pairsPerBatch=pairsPerBatch, transforms=inputMatrices,
+            pyramidLevels=pyramidLevels, views=views, returnQuality=True, cpuTimes=cpuTimes)
+        shifts += pairShifts
+        peaks += pairPeaks
+    if stateFileName:
+        np.savez(stateFileName, tiltAngles=tiltAngles, shifts=shifts, peaks=peaks,
+                 transforms=viewTransforms, parameters=parameters)
+
+    globalMatrices = alignment.composeShifts(shifts, tiltAngles, rotationAngle) @ viewTransforms
+    globalMatrices = alignment.bridgeMatrices(globalMatrices, views, nImages)
+    # Relative shifts of the skipped views are left to zero
+    allShifts = np.zeros((nImages, 2))
+    allShifts[views] = shifts
+    if matricesFileName:
+        np.save(matricesFileName, globalMatrices)
+    if prexfFileName:
+        alignment.writeXfFile(alignment.shiftsToMatrices(allShifts), prexfFileName)
+    if prexgFileName:
+        alignment.writeXfFile(globalMatrices, prexgFileName)
+    if qualityFileName:
+        quality = np.zeros((nImages, len(QUALITY_FIELDS)))
+        quality[views, 0:2] = peaks
+        quality[views, 2] = alignment.shiftResiduals(shifts)
+        np.save(qualityFileName, quality)
+    if patchesFileName:
+        _savePatchShifts(stackFileName, tiltAngles, shifts, inputMatrices, views, nImages,
+                         rotationAngle, patchesFileName, patchSize, patchOverlap, memoryLimit)
+    return globalMatrices
+
+
+def fitMemory(stackFileName, memoryLimit, workers, pyramidLevels=1):
+    """Workers and view pairs per FFT batch to correlate a stack within
+    memoryLimit bytes. Workers are only reduced when a single pair per
+    batch would not fit."""
+    with mrcfile.open(stackFileName, header_only=True, permissive=True) as mrc:
+        shape = (int(mrc.header.ny), int(mrc.header.nx))
+    workers = int(max(1, min(workers, memoryLimit // alignment.xcorrMemory(shape, 1,
+                                                                         pyramidLevels))))
+    return workers, alignment.fitPairsPerBatch(shape, memoryLimit / workers, pyramidLevels)
+
+
+def _savePatchShifts(stackFileName, tiltAngles, shifts, transforms, views, nImages,
+                     rotationAngle, patchesFileName, patchSize, patchOverlap, memoryLimit=None):
+    """Compute the local shifts of the aligned views and save them in the
+    indexes of the whole stack."""
+    with mrcfile.mmap(stackFileName, mode='r', permissive=True) as mrc:
+        centers, viewShifts, viewPeaks = alignment.computePatchShifts(
+            mrc.data, tiltAngles, shifts, rotationAngle=rotationAngle,
+            sigma1=FILTER_SIGMA1, sigma2=FILTER_SIGMA2, radius2=FILTER_RADIUS2,
+            transforms=transforms, views=views, patchSize=patchSize, overlap=patchOverlap,
+            memoryLimit=memoryLimit)
+    patchShifts = np.zeros((nImages,) + viewShifts.shape[1:])
+    patchShifts[views] = viewShifts
+    peaks = np.zeros((nImages,) + viewPeaks.shape[1:])
+    peaks[views] = viewPeaks
+    np.savez(patchesFileName, centers=centers, shifts=patchShifts, peaks=peaks)
+
+
+def alignmentScore(quality):
+    """Summary score of the alignment of a tilt-series: median normalized
+    peak height of the correlated views, between -1 and 1."""
+    correlated = quality[:, 1] != 0
+    return float(np.median(quality[correlated, 0])) if correlated.any() else 0.0
+
+
+def _loadState(stateFileName, tiltAngles, transforms, parameters):
+    """Neighbour shifts and correlation peaks of a previous run on this stack
+    that can be reused, and the view pairs that still have to be correlated."""
+    nImages = len(tiltAngles)
+    if stateFileName and os.path.exists(stateFileName):
+        state = np.load(stateFileName)
+        if 'peaks' in state and state['parameters'].shape == parameters.shape and \
+                np.allclose(state['parameters'], parameters):
+            values, pairs = alignment.reusePairShifts(tiltAngles, transforms, state['tiltAngles'],
+                                                      np.hstack([state['shifts'], state['peaks']]),
+                                                      state['transforms'])
+            return values[:, 0:2], values[:, 2:4], pairs
+    return np.zeros((nImages, 2)), np.zeros((nImages, 2)), list(range(1, nImages))
+
+
+def selectViews(stackFileName, views=None, excludeDark=False):
+    """Indexes of the views of a stack to align: the given ones, or all of
+    them, without the dark or empty ones if excludeDark."""
+    with mrcfile.mmap(stackFileName, mode='r', permissive=True) as mrc:
+        views = list(range(len(mrc.data))) if views is None else list(views)
+        if excludeDark:
+            darkViews = set(alignment.findDarkViews(mrc.data))
+            views = [i for i in views if i not in darkViews]
+    return views
+
+
+def interpolateStack(stackFileName, matrices, outputFileName, binning=1, views=None,
+                     mode=OUTPUT_MODES[0]):
+    """Write the stack aligned with the (N, 3, 3) matrices and binned. Only
+    the given views are written, when given. Return the (scale, offset) of
+    the values of an integer mode, None for float32."""
+    return alignment.writeAlignedStack(stackFileName, outputFileName, matrices,
+                                       binning=binning, views=views, dtype=np.dtype(mode))
+
+
+def convertStack(locations, outputFileName, matrices=None):
+    """Write the views at the (index, fileName) locations (indexes from 1) in
+    a new stack, transformed by the (N, 3, 3) matrices if given."""
+    alignment.writeTransformedStack(locations, outputFileName, matrices)
+
+
+def readLocations(fileName):
+    """(index, fileName) locations of a file with one "index fileName" line
+    per view."""
+    with open(fileName) as f:
+        return [(int(index), imageFileName) for index, imageFileName in
+                (line.rstrip('\n').split(' ', 1) for line in f if line.strip())]
+
+
+def readMatrices(fileName):
+    """(N, 3, 3) transformation matrices of a .npy or IMOD .xf file."""
+    if fileName.endswith('.npy'):
+        return np.load(fileName)
+    return alignment.readXfFile(fileName)
+
+
+def parseViews(text):
+    """View indexes of a comma separated list, None when empty."""
+    return [int(view) for view in text.split(',')] if text else None
+
+
+def readTiltFile(fileName):
+    """Tilt angles of an IMOD .rawtlt/.tlt file."""
+    return np.loadtxt(fileName, ndmin=1).tolist()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='TomoJ prealignment steps of a tilt-series.')
+    parser.add_argument('--scratch',
+                        help='Node-local folder where the stacks are processed')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    xcorrParser = subparsers.add_parser('xcorr', help='Compute the transformation matrices')
+    xcorrParser.add_argument('--input', required=True, help='MRC stack')
+    xcorrParser.add_argument('--tilts', required=True, help='Tilt angles file (.rawtlt)')
+    xcorrParser.add_argument('--matrices', help='Output global transforms (.npy)')
+    xcorrParser.add_argument('--prexf', help='Output relative transforms (IMOD .xf)')
+    xcorrParser.add_argument('--prexg', help='Output global transforms (IMOD .xf)')
+    xcorrParser.add_argument('--xform',
+                             help='Transforms to apply to the input views (.npy or IMOD .xf)')
+    xcorrParser.add_argument('--state', help='File to keep the neighbour shifts between runs')
+    xcorrParser.add_argument('--rotation-angle', type=float, default=0.0,
+                             help='Tilt axis angle from the vertical (degrees)')
+    xcorrParser.add_argument('--pyramid-levels', type=int, default=1)
+    xcorrParser.add_argument('--workers', type=int, default=1,
+                             help='Processes to correlate the view pairs')
+    xcorrParser.add_argument('--views',
+                             help='Comma separated indexes (from 0) of the views to align')
+    xcorrParser.add_argument('--exclude-dark', action='store_true',
+                             help='Do not align the dark or empty views')
+    xcorrParser.add_argument('--quality', help='Output alignment quality of the views (.npy)')
+    xcorrParser.add_argument('--patches',
+                             help='Output local shifts of overlapping patches (.npz)')
+    xcorrParser.add_argument('--patch-size', type=int, default=PATCH_SIZE,
+                             help='Side of the patches (pixels)')
+    xcorrParser.add_argument('--patch-overlap', type=float, default=PATCH_OVERLAP,
+                             help='Overlap fraction of neighbouring patches')
+    xcorrParser.add_argument('--memory', type=float,
+                             help='Memory the correlation may take (GB)')
+
+    interpolateParser = subparsers.add_parser('interpolate', help='Write the aligned stack')
+    interpolateParser.add_argument('--input', required=True, help='MRC stack')
+    interpolateParser.add_argument('--xform', required=True,
+                                   help='Global transforms (.npy or IMOD .prexg)')
+    interpolateParser.add_argument('--output', required=True, help='Output MRC stack')
+    interpolateParser.add_argument('--bin', type=int, default=1)
+    interpolateParser.add_argument('--views',
+                                   help='Comma separated indexes (from 0) of the views to write')
+    interpolateParser.add_argument('--mode', choices=OUTPUT_MODES, default=OUTPUT_MODES[0],
+                                   help='Data type of the output. Integer values are '
+                                        'scaled to the input range, the scaling is recorded '
+                                        'in a header label')
+
+    convertParser = subparsers.add_parser('convert',
+                                          help='Write the input views in a single stack')
+    convertParser.add_argument('--images', required=True,
+                               help='File with an "index fileName" line per view, '
+                                    'indexes from 1')
+    convertParser.add_argument('--xform',
+                               help='Transforms to apply to the views (.npy or IMOD .xf)')
+    convertParser.add_argument('--output', required=True, help='Output MRC stack')
+
+    args = parser.parse_args(args)
+    if args.command == 'xcorr':
+        inputs = [args.input, args.state]
+        outputs = [args.state, args.quality, args.patches, args.prexf, args.prexg,
+                   args.matrices]
+    elif args.command == 'interpolate':
+        inputs, outputs = [args.input], [args.output]
+    else:
+        inputs, outputs = [], [args.output]
+
+    with scratch.stagedFiles(args.scratch, inputs, outputs) as local:
+        if args.command == 'xcorr':
+            alignStack(local(args.input), readTiltFile(args.tilts),
+                       matricesFileName=local(args.matrices),
+                       prexfFileName=local(args.prexf), prexgFileName=local(args.prexg),
+                       inputMatricesFileName=args.xform, stateFileName=local(args.state),
+                       rotationAngle=args.rotation_angle, pyramidLevels=args.pyramid_levels,
+                       workers=args.workers,
+                       views=selectViews(local(args.input), parseViews(args.views),
+                                         args.exclude_dark),
+                       qualityFileName=local(args.quality),
+                       patchesFileName=local(args.patches),
+                       patchSize=args.patch_size, patchOverlap=args.patch_overlap,
+                       memoryLimit=args.memory * 1024 ** 3 if args.memory else None)
+        elif args.command == 'interpolate':
+            interpolateStack(local(args.input), readMatrices(args.xform), local(args.output),
+                             binning=args.bin, views=parseViews(args.views), mode=args.mode)
+        else:
+            convertStack(readLocations(args.images), local(args.output),
+                         readMatrices(args.xform) if args.xform else None)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -24,15 +24,54 @@
 # *
 # **************************************************************************
 
+import functools
 import os
-import numpy as np
-import imod.utils as utils
-import pwem.objects as data
+import sys
+import threading
+import time
+from collections import OrderedDict
 import pyworkflow.protocol.params as params
+from pyworkflow.object import Set, Float, String
+from pyworkflow.protocol import STEPS_PARALLEL
+from pyworkflow.protocol.constants import STATUS_NEW
 import pyworkflow.utils.path as path
+from pyworkflow.utils import prettySize
 from pwem.protocols import EMProtocol
-import tomo.objects as tomoObj
 from tomo.protocols import ProtTomoBase
+from tomoj import Plugin, scratch
+from tomoj import utils as tomojUtils
+from tomoj.constants import (XCORR_ENGINE_TOMOJ, FILTER_SIGMA1, FILTER_SIGMA2,
+                             FILTER_RADIUS2, TOMOJ_CACHE, TOMOJ_CACHE_SIZE,
+                             TOMOJ_SCRATCH, OUTPUT_FLUSH_SERIES, OUTPUT_FLUSH_SECONDS,
+                             PATCH_SIZE, PATCH_OVERLAP, MRC_EXTENSIONS, OUTPUT_MODES)
+
+
+def measureStep(stepFunc):
+    """Record the wall, CPU and external programs time of a tilt-series step,
+    and the bytes of the files it reports as read and written. The CPU time
+    is that of the step thread and of the worker processes it reports."""
+    @functools.wraps(stepFunc)
+    def wrapper(self, tsObjId, *args):
+        stepData = self._stepData
+        stepData.externalTime = 0.0
+        stepData.workerCpuTime = 0.0
+        stepData.inputFiles = []
+        stepData.outputFiles = []
+        wallStart, cpuStart = time.perf_counter(), time.thread_time()
+
+        result = stepFunc(self, tsObjId, *args)
+
+        stats = {'step': stepFunc.__name__,
+                 'tsId': self.inputSetOfTiltSeries.get()[tsObjId].getTsId(),
+                 'wallTime': time.perf_counter() - wallStart,
+                 'cpuTime': time.thread_time() - cpuStart + stepData.workerCpuTime,
+                 'externalTime': stepData.externalTime,
+                 'inputBytes': tomojUtils.filesSize(stepData.inputFiles),
+                 'outputBytes': tomojUtils.filesSize(stepData.outputFiles)}
+        with self._outputLock:
+            tomojUtils.appendStepStats(self._getStepStatsFileName(), stats)
+        return result
+    return wrapper
 
 
 class ProtTomojXcorrPrealignment(EMProtocol, ProtTomoBase):
@@ -46,6 +85,18 @@ class ProtTomojXcorrPrealignment(EMProtocol, ProtTomoBase):
 
     def __init__(self, **kwargs):
         EMProtocol.__init__(self, **kwargs)
+        self.stepsExecutionMode = STEPS_PARALLEL
+        self._outputLock = threading.Lock()
+        self._stepData = threading.local()
+        # Output tilt-series to write at the next flush once the files they
+        # refer to are written back: (set file, tsId) -> (set, ts, write-back)
+        self._pendingTs = OrderedDict()
+        self._lastOutputFlush = time.time()
+        self._stager = scratch.FileStager()
+        self._stackQueue = OrderedDict()
+        self._tmpReleased = threading.Condition()
+        self._waitingConverts = 0
+        self._openedOutputs = set()
 
     # -------------------------- DEFINE param functions -----------------------
     def _defineParams(self, form):
@@ -67,12 +118,36 @@ class ProtTomojXcorrPrealignment(EMProtocol, ProtTomoBase):
         group = form.addGroup('Interpolated tilt-series',
                               condition='computeAlignment==0')
 
+        group.addParam('virtualInterpolation', params.BooleanParam,
+                       default=False,
+                       label='Virtual interpolated tilt-series',
+                       help='Do not write the interpolated stacks. The interpolated '
+                            'tilt-images reference the input stack together with the '
+                            'transformation to apply, so the aligned pixels are only '
+                            'computed by the protocols that read them (e.g. with '
+                            'tomoj.alignment.VirtualAlignedStack).')
+
         group.addParam('binning', params.FloatParam,
                        default=1.0,
+                       condition='not virtualInterpolation',
                        label='Binning',
                        help='Binning to be applied to the interpolated tilt-series. '
                             'Must be a integer bigger than 1')
 
+        group.addParam('outputPrecision', params.EnumParam,
+                       choices=['32-bit float', '16-bit integer', '8-bit integer'],
+                       default=0,
+                       condition='not virtualInterpolation and xcorrEngine==%d'
+                                 % XCORR_ENGINE_TOMOJ,
+                       label='Precision',
+                       display=params.EnumParam.DISPLAY_HLIST,
+                       help='Data type of the interpolated stacks. Integer stacks take '
+                            'half or a quarter of the space, enough for visual checks '
+                            'and coarse reconstructions. Their values are scaled to the '
+                            'range of the input stack: value = stored * scale + offset, '
+                            'with the _tomojIntensityScale and _tomojIntensityOffset of '
+                            'the interpolated tilt-series.')
+
         form.addParam('rotationAngle',
                       params.FloatParam,
                       label='Tilt rotation angle (deg)',
@@ -80,46 +155,920 @@ class ProtTomojXcorrPrealignment(EMProtocol, ProtTomoBase):
                       expertLevel=params.LEVEL_ADVANCED,
                       help="Angle from the vertical to the tilt axis in raw images.")
 
+        form.addParam('excludeDisabledViews', params.BooleanParam,
+                      default=False,
+                      label='Skip excluded views',
+                      help='Do not align the tilt-images disabled in the input '
+                           'tilt-series, nor write them in the interpolated '
+                           'tilt-series. Their transformation is interpolated from '
+                           'the neighbouring tilt-images.')
+
+        form.addParam('excludeDarkViews', params.BooleanParam,
+                      default=False,
+                      label='Skip dark views',
+                      help='Detect the empty or dark tilt-images (e.g. blocked by the '
+                           'grid at high tilt) and skip them as the excluded ones. '
+                           'They are disabled in the output tilt-series.')
+
+        form.addParam('xcorrEngine', params.EnumParam,
+                      choices=['TomoJ (in-process)', 'IMOD tiltxcorr'],
+                      default=XCORR_ENGINE_TOMOJ,
+                      label='Processing engine',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      help='TomoJ: batched FFT cross-correlation of neighbouring tilts '
+                           'and interpolation computed within Scipion, it does not '
+                           'require IMOD. It also records the alignment quality of the '
+                           'output tilt-images: normalized correlation peak height '
+                           '(_tomojPeakHeight), peak-to-noise ratio (_tomojPeakToNoise) and '
+                           'deviation of the shift from the local drift in pixels '
+                           '(_tomojResidualShift), and the median peak height of every '
+                           'tilt-series (_tomojAlignmentScore).\n'
+                           'IMOD: run the external tiltxcorr, xftoxg and newstack programs.')
+
+        form.addParam('pyramidLevels', params.IntParam,
+                      default=1,
+                      condition='xcorrEngine==%d' % XCORR_ENGINE_TOMOJ,
+                      label='Pyramid levels',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      validators=[params.Positive],
+                      help='Number of resolution levels for a coarse-to-fine '
+                           'cross-correlation. With more than one level, the views '
+                           'are only correlated as a whole binned by 2^(levels-1); the '
+                           'shifts are then refined at each finer level in a small '
+                           'central region. 1 correlates the full views at full '
+                           'resolution. 3 or 4 are good values for large '
+                           '(e.g. super-resolution) images.')
+
+        form.addParam('localShifts', params.BooleanParam,
+                      default=False,
+                      condition='xcorrEngine==%d' % XCORR_ENGINE_TOMOJ,
+                      label='Compute local shifts',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Also correlate overlapping patches of the neighbouring '
+                           'views once they are globally aligned, to measure the local '
+                           'deformations of the sample. The patch centers, shifts and '
+                           'peak heights are saved to <tsId>_patches.npz in the extra '
+                           'folder (_tomojPatchShiftsFile of the output tilt-series). '
+                           'They do not change the global alignment.')
+
+        line = form.addLine('Patches',
+                            condition='localShifts and xcorrEngine==%d' % XCORR_ENGINE_TOMOJ,
+                            expertLevel=params.LEVEL_ADVANCED,
+                            help='Side of the square patches in pixels and overlap '
+                                 'fraction of neighbouring patches.')
+        line.addParam('patchSize', params.IntParam,
+                      default=PATCH_SIZE,
+                      validators=[params.Positive],
+                      label='Size (px)')
+        line.addParam('patchOverlap', params.FloatParam,
+                      default=PATCH_OVERLAP,
+                      validators=[params.Range(0, 0.9)],
+                      label='Overlap')
+
+        form.addParam('writeXfFiles', params.BooleanParam,
+                      default=False,
+                      label='Write IMOD transformation files',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Also write the relative (.prexf) and global (.prexg) '
+                           'transformations as IMOD text files in the extra folder. '
+                           'The output tilt-series get the transformation matrices '
+                           'directly and do not need them. They are always written '
+                           'by the IMOD engine.')
+
+        form.addParam('maxTmpSize', params.FloatParam,
+                      default=0,
+                      label='Maximum size of temporary files (GB)',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='New tilt-series are not converted while their temporary '
+                           'files would exceed this size, until those of the '
+                           'tilt-series in progress are removed. 0 for no limit.')
+
+        form.addParam('memoryLimit', params.FloatParam,
+                      default=0,
+                      label='Memory limit (GB)',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Memory the processing may take, shared by the tilt-series '
+                           'processed at the same time. Stacks are read and written a '
+                           'few tilt-images at a time, and the TomoJ engine correlates '
+                           'fewer tilt-image pairs per FFT batch to fit within it. '
+                           '0 for no limit.')
+
+        form.addParam('keepTmpFiles', params.BooleanParam,
+                      default=False,
+                      label='Keep temporary files (debug)',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Move the temporary files of every tilt-series to the extra '
+                           'folder instead of removing them once it is processed.')
+
+        form.addParam('exportStepStats', params.BooleanParam,
+                      default=False,
+                      label='Export step statistics',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help='Write the time and I/O of every step and tilt-series to '
+                           'step_stats.csv and step_stats.json in the extra folder.')
+
+        form.addParallelSection(threads=4, mpi=1)
+
     # -------------------------- INSERT steps functions ---------------------
     def _insertAllSteps(self):
-        for ts in self.inputSetOfTiltSeries.get():
-            self._insertFunctionStep('convertInputStep', ts.getObjId())
-            self._insertFunctionStep('computeXcorrStep', ts.getObjId())
+        self._insertedTs = {}
+        inputSet = self.inputSetOfTiltSeries.get()
+        stepIds = self._insertNewTsSteps(inputSet)
+        # In streaming, the output sets are closed once the input stream is closed
+        self._insertFunctionStep('closeOutputSetsStep',
+                                 prerequisites=stepIds,
+                                 wait=inputSet.isStreamOpen())
+
+    def _insertNewTsSteps(self, inputSet):
+        """Insert the steps for the tilt-series of inputSet that have not been
+        inserted yet, or that have new tilt-images since they were inserted
+        (acquisition in progress). Return the ids of the last step of each of them."""
+        stepIds = []
+        # Each tilt-series gets its own chain of steps so that independent
+        # tilt-series are processed concurrently. The chain of a tilt-series
+        # that grew waits for the previous one to reuse its results.
+        for ts in inputSet:
+            tsId = ts.getTsId()
+            size, previousStepId = self._insertedTs.get(tsId, (0, None))
+            if ts.getSize() <= size:
+                continue
+
+            convertStepId = self._insertFunctionStep('convertInputStep', ts.getObjId(),
+                                                     prerequisites=[previousStepId]
+                                                     if previousStepId else [])
+            lastStepId = self._insertFunctionStep('computeXcorrStep', ts.getObjId(),
+                                                  prerequisites=[convertStepId])
             if self.computeAlignment.get() == 0:
-                self._insertFunctionStep('computeInterpolatedStackStep', ts.getObjId())
+                lastStepId = self._insertFunctionStep('computeInterpolatedStackStep', ts.getObjId(),
+                                                      prerequisites=[lastStepId])
+            self._insertedTs[tsId] = (ts.getSize(), lastStepId)
+            stepIds.append(lastStepId)
+            # Processed tilt-series are not converted, their stacks are not prefetched
+            if self._getScratchDir() and self._usesInputStack(ts) and not self._isProcessed(ts):
+                self._stackQueue[tsId] = os.path.abspath(ts.getFirstItem().getFileName())
+        return stepIds
+
+    def _stepsCheck(self):
+        self._checkNewInput()
+        self._checkPendingOutputs()
+
+    def _checkNewInput(self):
+        """Insert steps for the tilt-series that arrived or grew since the last
+        check and release the closing step when the input stream is closed."""
+        import tomo.objects as tomoObj
+        closeStep = self._getCloseOutputSetsStep()
+        if closeStep is None or not closeStep.isWaiting():
+            return
+
+        inputFileName = self.inputSetOfTiltSeries.get().getFileName()
+        lastCheck = getattr(self, '_lastInputCheck', 0)
+        if os.path.getmtime(inputFileName) < lastCheck:
+            return
+        self._lastInputCheck = time.time()
+
+        inputSet = tomoObj.SetOfTiltSeries(filename=inputFileName)
+        inputSet.loadAllProperties()
+        newStepIds = self._insertNewTsSteps(inputSet)
+        streamClosed = inputSet.isStreamClosed()
+        inputSet.close()
+
+        if newStepIds:
+            closeStep.addPrerequisites(*newStepIds)
+        if streamClosed:
+            closeStep.setStatus(STATUS_NEW)
+        if newStepIds or streamClosed:
+            self.updateSteps()
+
+    def _checkPendingOutputs(self):
+        """Flush the output tilt-series that have been waiting for too long,
+        e.g. while in streaming no new tilt-series arrive."""
+        with self._outputLock:
+            if self._pendingTs and \
+                    time.time() - self._lastOutputFlush >= OUTPUT_FLUSH_SECONDS:
+                self._flushOutputs()
 
     # --------------------------- STEPS functions ----------------------------
+    @measureStep
     def convertInputStep(self, tsObjId):
+        import numpy as np
+        from tomoj import alignment
         ts = self.inputSetOfTiltSeries.get()[tsObjId]
         tsId = ts.getTsId()
+        # Not to be prefetched any more, whether it is converted or not
+        self._stackQueue.pop(tsId, None)
+        if self._isProcessed(ts):
+            """Results of a previous execution, nothing to convert"""
+            self.info("%s already processed, its results are reused" % tsId)
+            return
+
+        self._waitForTmpSpace(ts)
         extraPrefix = self._getExtraPath(tsId)
-        tmpPrefix = self._getTmpPath(tsId)
+        tmpPrefix = self._getTsTmpPath(tsId)
         path.makePath(tmpPrefix)
         path.makePath(extraPrefix)
         outputTsFileName = os.path.join(tmpPrefix, "%s.st" % tsId)
+        inputMatricesFileName = self._getInputMatricesFileName(tsId)
+        # Files from a previous run of a tilt-series that has grown since then
+        path.cleanPath(outputTsFileName, inputMatricesFileName)
+        inputMatrices = self._getInputTransforms(ts)
 
-        """Apply the transformation form the input tilt-series"""
-        ts.applyTransform(outputTsFileName)
+        if self._usesInputStack(ts):
+            """Use the input stack, its transformation is composed into the alignment"""
+            inputStackFileName = os.path.abspath(ts.getFirstItem().getFileName())
+            if self._getScratchDir():
+                self._prefetchNextStack()
+                self._stager.fetch(inputStackFileName, outputTsFileName)
+                self._countStepIO(inputs=[inputStackFileName], outputs=[outputTsFileName])
+            else:
+                path.createLink(inputStackFileName, outputTsFileName)
+            if not alignment.isIdentity(inputMatrices):
+                np.save(inputMatricesFileName, inputMatrices)
+        else:
+            """Apply the transformation form the input tilt-series"""
+            if self._isMrcTs(ts) and self._useMpi():
+                """Run as a job so that the MPI executor sends it to a free node"""
+                imagesFileName = os.path.join(tmpPrefix, '%s_images.txt' % tsId)
+                transformsFileName = os.path.join(tmpPrefix, '%s_applied.npy' % tsId)
+                with open(imagesFileName, 'w') as f:
+                    for index, fileName in (tiltImage.getLocation() for tiltImage in ts):
+                        f.write('%d %s\n' % (index, fileName))
+                np.save(transformsFileName, inputMatrices)
+                self.runJob(sys.executable, self._getPipelineArgs('convert') +
+                            " --images %s --xform %s --output %s"
+                            % (imagesFileName, transformsFileName, outputTsFileName))
+            elif self._isMrcTs(ts):
+                # One tilt-image at a time, whatever the size of the stack
+                alignment.writeTransformedStack([tiltImage.getLocation() for tiltImage in ts],
+                                                outputTsFileName, inputMatrices)
+            else:
+                ts.applyTransform(outputTsFileName)
+            self._countStepIO(inputs=[tiltImage.getFileName() for tiltImage in ts],
+                              outputs=[outputTsFileName])
 
         """Generate angle file"""
         angleFilePath = os.path.join(tmpPrefix, "%s.rawtlt" % tsId)
         ts.generateTltFile(angleFilePath)
+        self._countStepIO(outputs=[angleFilePath])
 
+    @measureStep
     def computeXcorrStep(self, tsObjId):
         """Compute transformation matrix for each tilt series"""
+        import numpy as np
+        from tomoj import cache
         ts = self.inputSetOfTiltSeries.get()[tsObjId]
         tsId = ts.getTsId()
+        matrices = self._loadXcorrResult(ts)
+
+        if matrices is not None:
+            self.info("Transformation matrices of %s reused from a previous execution" % tsId)
+        else:
+            path.cleanPath(self._getXcorrKeyFileName(tsId))
+            resultFileNames = self._getXcorrResultFileNames(tsId)
+            cacheDir = Plugin.getVar(TOMOJ_CACHE)
+            key = self._getXcorrCacheKey(ts)
+            if cacheDir:
+                if cache.fetch(cacheDir, key, resultFileNames):
+                    self.info("Transformation matrices of %s reused from the cache" % tsId)
+                    matrices = np.load(self._getMatricesFileName(tsId))
+                else:
+                    matrices = self._computeXcorr(ts)
+                    os.makedirs(cacheDir, exist_ok=True)
+                    cache.store(cacheDir, key, resultFileNames,
+                                float(Plugin.getVar(TOMOJ_CACHE_SIZE)) * 1024 ** 3)
+            else:
+                matrices = self._computeXcorr(ts)
+            self._countStepIO(outputs=resultFileNames)
+            # Written last: the results are complete when it matches
+            self._writeKey(self._getXcorrKeyFileName(tsId), key)
+
+        self._updateOutput(ts)
+
+        if self.computeAlignment.get() != 0:
+            self._releaseTmp(tsId)
+
+    @measureStep
+    def computeInterpolatedStackStep(self, tsObjId):
+        import numpy as np
+        from tomoj import pipeline
+        ts = self.inputSetOfTiltSeries.get()[tsObjId]
+
+        tsId = ts.getTsId()
+        extraPrefix = self._getExtraPath(tsId)
+        tmpPrefix = self._getTsTmpPath(tsId)
+
+        inputTsFileName = os.path.join(tmpPrefix, '%s.st' % tsId)
+        outputTsFileName = self._getInterpolatedFileName(tsId)
+        xfFileName = os.path.join(extraPrefix, "%s.prexg" % tsId)
+        keyFileName = self._getInterpolationKeyFileName(tsId)
+        # In the scratch folder, the stack is written locally and moved to the
+        # project in the background
+        writtenTsFileName = self._getScratchOutputPath(os.path.basename(outputTsFileName)) \
+            if self._getScratchDir() else outputTsFileName
+        writtenKeyFileName = self._getScratchOutputPath(os.path.basename(keyFileName)) \
+            if self._getScratchDir() else keyFileName
+
+        binning = self._getInterpolationBinning()
+        views = self._loadViews(tsId)
+        reused = not self.virtualInterpolation and self._hasInterpolationResult(ts)
+        if not (self.virtualInterpolation or reused):
+            # Invalid until the new stack is completely written
+            path.cleanPath(keyFileName)
+
+        if self.virtualInterpolation:
+            pass
+        elif reused:
+            self.info("Interpolated tilt-series %s reused from a previous execution" % tsId)
+        elif self.xcorrEngine.get() == XCORR_ENGINE_TOMOJ and not self._useMpi():
+            pipeline.interpolateStack(inputTsFileName, np.load(self._getMatricesFileName(tsId)),
+                                      writtenTsFileName, binning=binning, views=views,
+                                      mode=self._getOutputMode())
+        elif self.xcorrEngine.get() == XCORR_ENGINE_TOMOJ:
+            self.runJob(sys.executable, self._getPipelineArgs('interpolate') +
+                        " --input %s --xform %s --output %s --bin %d --views %s --mode %s"
+                        % (inputTsFileName, self._getMatricesFileName(tsId),
+                           outputTsFileName, binning, ','.join(map(str, views)),
+                           self._getOutputMode()))
+        else:
+            paramsAlignment = {
+                'input': inputTsFileName,
+                'output': writtenTsFileName,
+                'xform': xfFileName,
+                'bin': binning,
+                'imagebinned': 1.0
+            }
+            argsAlignment = "-input %(input)s " \
+                            "-output %(output)s " \
+                            "-xform %(xform)s " \
+                            "-bin %(bin)d " \
+                            "-imagebinned %(imagebinned)s"
+            if len(views) < ts.getSize():
+                # Sections and transform lines numbered from 0
+                argsAlignment += " -secs %(views)s -uselines %(views)s"
+                paramsAlignment['views'] = ','.join(map(str, views))
+            self.runJob('newstack', argsAlignment % paramsAlignment)
+
+        scaling, writtenBack = None, None
+        if not (self.virtualInterpolation or reused):
+            self._countStepIO(inputs=[inputTsFileName], outputs=[writtenTsFileName])
+            self._writeKey(writtenKeyFileName, self._getInterpolationKey(ts))
+            # Read before the stack may be moved to the project
+            scaling = self._readIntensityScaling(writtenTsFileName)
+            if writtenTsFileName != outputTsFileName:
+                # In this order: the key is moved once the stack is in place
+                self._stager.writeBack(writtenTsFileName, outputTsFileName)
+                writtenBack = self._stager.writeBack(writtenKeyFileName, keyFileName)
+
+        self._updateInterpolatedOutput(ts, scaling, writtenBack)
+
+        self._releaseTmp(tsId)
+
+    def closeOutputSetsStep(self):
+        self._addMissingOutputs()
+        # Outside the output lock, steps may still be updating the outputs
+        self._stager.wait()
+        with self._outputLock:
+            for outputSet in self._getOutputSets():
+                outputSet.setStreamState(Set.STREAM_CLOSED)
+            self._flushOutputs()
+
+        if self.exportStepStats:
+            tomojUtils.exportStepStats(tomojUtils.readStepStats(self._getStepStatsFileName()),
+                                       csvFileName=self._getExtraPath('step_stats.csv'),
+                                       jsonFileName=self._getExtraPath('step_stats.json'))
+
+        if self._getScratchDir() and not self.keepTmpFiles:
+            path.cleanPath(self._getScratchDir())
+
+    # --------------------------- UTILS functions ----------------------------
+    def _updateOutput(self, ts):
+        """Add ts with the alignment matrices to the output tilt-series, or
+        update it if it is already there. The matrices are referred to the
+        input tilt-images, as those of the virtual interpolated output."""
+        import numpy as np
+        import pwem.objects as data
+        import tomo.objects as tomoObj
+        from tomoj import pipeline
+        tsId = ts.getTsId()
+        views = set(self._loadViews(tsId))
+        matrices = self._getInputStackTransforms(ts)
+        qualityFileName = self._getQualityFileName(tsId)
+        quality = np.load(qualityFileName) if os.path.exists(qualityFileName) else None
+        tiltImages = []
+        for index, (tiltImage, matrix) in enumerate(zip(ts, matrices)):
+            newTi = tomoObj.TiltImage()
+            newTi.copyInfo(tiltImage, copyId=True)
+            newTi.setLocation(tiltImage.getLocation())
+            newTi.setTransform(data.Transform(matrix))
+            newTi.setEnabled(tiltImage.isEnabled() and index in views)
+            if quality is not None:
+                for field, value in zip(pipeline.QUALITY_FIELDS, quality[index]):
+                    setattr(newTi, self._getQualityAttribute(field), Float(value))
+            tiltImages.append(newTi)
+
+        # Defined for every tilt-series of the set, which all need the same columns
+        attributes = {}
+        if self.xcorrEngine.get() == XCORR_ENGINE_TOMOJ:
+            attributes['_tomojAlignmentScore'] = \
+                Float(pipeline.alignmentScore(quality) if quality is not None else 0.0)
+        if self._computesPatchShifts():
+            attributes['_tomojPatchShiftsFile'] = String(self._getPatchesFileName(tsId))
+
+        with self._outputLock:
+            outputSetOfTiltSeries = self.getOutputSetOfTiltSeries()
+            newTs, existingIds = self._getOutputTs(outputSetOfTiltSeries, ts, attributes)
+            for newTi in tiltImages:
+                self._appendOrUpdate(newTs, newTi, existingIds)
+            self._outputUpdated(outputSetOfTiltSeries, newTs)
+
+    def _updateInterpolatedOutput(self, ts, scaling=None, writtenBack=None):
+        """Add ts to the interpolated tilt-series, or update it if it is
+        already there. scaling is the (scale, offset) of the values of an
+        integer stack, read from the stack when not given. writtenBack is the
+        future of the write-back of the stack, if it is still pending."""
+        import pwem.objects as data
+        import tomo.objects as tomoObj
+        outputTsFileName = self._getInterpolatedFileName(ts.getTsId())
+        binning = self._getInterpolationBinning()
+        if scaling is None:
+            scaling = self._readIntensityScaling(outputTsFileName)
+        # Skipped views are left out of the interpolated tilt-series
+        positions = {index: n for n, index in enumerate(self._loadViews(ts.getTsId()))}
+        if self.virtualInterpolation:
+            matrices = self._getInputStackTransforms(ts)
+        # Defined for every tilt-series of an integer set, which all need the
+        # same columns
+        attributes = {}
+        if not self.virtualInterpolation and self._getOutputMode() != OUTPUT_MODES[0]:
+            scale, offset = scaling if scaling is not None else (1.0, 0.0)
+            attributes['_tomojIntensityScale'] = Float(scale)
+            attributes['_tomojIntensityOffset'] = Float(offset)
+
+        with self._outputLock:
+            outputInterpolatedSetOfTiltSeries = self.getOutputInterpolatedSetOfTiltSeries()
+            newTs, existingIds = self._getOutputTs(outputInterpolatedSetOfTiltSeries, ts,
+                                                   attributes)
+            for index, tiltImage in enumerate(ts):
+                if index not in positions:
+                    continue
+                newTi = tomoObj.TiltImage()
+                newTi.copyInfo(tiltImage, copyId=True)
+                if self.virtualInterpolation:
+                    newTi.setLocation(tiltImage.getLocation())
+                    newTi.setTransform(data.Transform(matrices[index]))
+                else:
+                    newTi.setLocation(positions[index] + 1, outputTsFileName)
+                if binning > 1:
+                    newTi.setSamplingRate(tiltImage.getSamplingRate() * binning)
+                self._appendOrUpdate(newTs, newTi, existingIds)
+            if binning > 1:
+                newTs.setSamplingRate(ts.getSamplingRate() * binning)
+            self._outputUpdated(outputInterpolatedSetOfTiltSeries, newTs, writtenBack)
+
+    def _addMissingOutputs(self):
+        """Add the tilt-series processed by an execution that was interrupted
+        before committing their outputs"""
+        import tomo.objects as tomoObj
+        with self._outputLock:
+            outputTsIds = self._getOutputTsIds('outputSetOfTiltSeries')
+            interpolatedTsIds = self._getOutputTsIds('outputInterpolatedSetOfTiltSeries')
+
+        inputSet = tomoObj.SetOfTiltSeries(filename=self.inputSetOfTiltSeries.get().getFileName())
+        inputSet.loadAllProperties()
+        for ts in inputSet:
+            tsId = ts.getTsId()
+            matrices = self._loadXcorrResult(ts)
+            if matrices is None:
+                continue
+            if tsId not in outputTsIds:
+                self._updateOutput(ts)
+            if self.computeAlignment.get() == 0 and tsId not in interpolatedTsIds and \
+                    (self.virtualInterpolation or self._hasInterpolationResult(ts)):
+                self._updateInterpolatedOutput(ts)
+        inputSet.close()
+
+    def _getOutputTsIds(self, outputName):
+        if not hasattr(self, outputName):
+            return set()
+        return set(getattr(self, outputName).getUniqueValues('_tsId'))
+
+    def _isProcessed(self, ts):
+        """Whether all the results of ts are there from a previous execution"""
+        return self._loadXcorrResult(ts) is not None and \
+            (self.computeAlignment.get() != 0 or self.virtualInterpolation or
+             self._hasInterpolationResult(ts))
+
+    def _loadXcorrResult(self, ts):
+        """Alignment matrices of ts computed by a previous execution from the
+        same input and parameters, None if there are none"""
+        import numpy as np
+        tsId = ts.getTsId()
+        if not all(os.path.exists(fileName) for fileName in self._getXcorrResultFileNames(tsId)) or \
+                self._readKey(self._getXcorrKeyFileName(tsId)) != self._getXcorrCacheKey(ts):
+            return None
+        try:
+            matrices = np.load(self._getMatricesFileName(tsId))
+        except (OSError, ValueError):
+            return None
+        return matrices if matrices.shape == (ts.getSize(), 3, 3) else None
+
+    def _hasInterpolationResult(self, ts):
+        """Whether the interpolated stack of ts was completely written by a
+        previous execution from the same alignment and binning"""
+        from tomoj import alignment
+        tsId = ts.getTsId()
+        return self._readKey(self._getInterpolationKeyFileName(tsId)) == \
+            self._getInterpolationKey(ts) and \
+            alignment.isCompleteStack(self._getInterpolatedFileName(tsId),
+                                      len(self._loadViews(tsId)))
+
+    def _getInterpolationKey(self, ts):
+        from tomoj import cache
+        return cache.cacheKey(self._getXcorrCacheKey(ts), self._getInterpolationBinning(),
+                              self._getOutputMode())
+
+    def _getOutputMode(self):
+        """Data type of the interpolated stacks, one of OUTPUT_MODES"""
+        if self.xcorrEngine.get() != XCORR_ENGINE_TOMOJ:
+            return OUTPUT_MODES[0]
+        return OUTPUT_MODES[self.outputPrecision.get()]
+
+    def _readIntensityScaling(self, stackFileName):
+        """(scale, offset) of the values of an integer interpolated stack,
+        None for float ones"""
+        from tomoj import alignment
+        if self.virtualInterpolation or self._getOutputMode() == OUTPUT_MODES[0]:
+            return None
+        return alignment.readIntensityScaling(stackFileName)
+
+    def _getXcorrKeyFileName(self, tsId):
+        return self._getExtraPath(tsId, '%s_xcorr.key' % tsId)
+
+    def _getInterpolationKeyFileName(self, tsId):
+        return self._getExtraPath(tsId, '%s_preali.key' % tsId)
+
+    def _getInterpolatedFileName(self, tsId):
+        return self._getExtraPath(tsId, '%s_preali.st' % tsId)
+
+    @staticmethod
+    def _readKey(fileName):
+        if not os.path.exists(fileName):
+            return None
+        with open(fileName) as f:
+            return f.read().strip()
+
+    @staticmethod
+    def _writeKey(fileName, key):
+        with open(fileName, 'w') as f:
+            f.write(key)
+
+    def runJob(self, program, arguments, **kwargs):
+        # Every job processes a single tilt-series: with MPI, the executor
+        # sends each of them to one node instead of running them over all
+        kwargs.setdefault('numberOfMpi', 1)
+        kwargs.setdefault('env', Plugin.getEnviron())
+        start = time.perf_counter()
+        try:
+            EMProtocol.runJob(self, program, arguments, **kwargs)
+        finally:
+            if hasattr(self._stepData, 'externalTime'):
+                self._stepData.externalTime += time.perf_counter() - start
+
+    def _outputUpdated(self, outputSet, newTs, writtenBack=None):
+        """Keep the updated newTs of outputSet to be written at the next
+        flush, and flush the output sets once enough tilt-series or time
+        have been accumulated. Called with the output lock held.
+
+        :param writtenBack: future of the write-back of the files newTs refers
+            to, it is not written before that is done.
+        """
+        self._pendingTs[(outputSet.getFileName(), newTs.getTsId())] = \
+            (outputSet, newTs, writtenBack)
+        if len(self._pendingTs) >= OUTPUT_FLUSH_SERIES or \
+                time.time() - self._lastOutputFlush >= OUTPUT_FLUSH_SECONDS:
+            self._flushOutputs()
+
+    def _flushOutputs(self):
+        """Write the pending tilt-series whose files have been written back to
+        the project, commit the output sets and store the protocol in a
+        single go. Called with the output lock held, so it never waits for
+        the write-backs: the others are left for the next flush."""
+        for key, (outputSet, newTs, writtenBack) in list(self._pendingTs.items()):
+            if writtenBack is not None and not writtenBack.done():
+                continue
+            if writtenBack is not None:
+                writtenBack.result()
+            newTs.write()
+            outputSet.update(newTs)  # update items and size info
+            del self._pendingTs[key]
+        for outputSet in self._getOutputSets():
+            outputSet.write()
+        self._store()
+        self._lastOutputFlush = time.time()
+
+    def _getOutputSets(self):
+        return [getattr(self, outputName)
+                for outputName in ('outputSetOfTiltSeries', 'outputInterpolatedSetOfTiltSeries')
+                if hasattr(self, outputName)]
+
+    def _countStepIO(self, inputs=(), outputs=()):
+        """Report files read and written by the running step"""
+        if hasattr(self._stepData, 'inputFiles'):
+            self._stepData.inputFiles.extend(inputs)
+            self._stepData.outputFiles.extend(outputs)
+
+    def _getStepStatsFileName(self):
+        return self._getExtraPath('step_stats.jsonl')
+
+    def _getCloseOutputSetsStep(self):
+        for step in self._steps:
+            if getattr(step, 'funcName', None) == 'closeOutputSetsStep':
+                return step
+        return None
+
+    def _computeXcorr(self, ts):
+        """Compute the (N, 3, 3) alignment matrices of the tilt-series and
+        save them in its matrices file"""
+        import numpy as np
+        tsId = ts.getTsId()
+        self._countStepIO(inputs=[self._getTsTmpPath(tsId, '%s.st' % tsId)])
+        views = self._selectViews(ts)
+        np.save(self._getViewsFileName(tsId), np.array(views, dtype=int))
+        if self.xcorrEngine.get() == XCORR_ENGINE_TOMOJ:
+            return self._computeXcorrTomoj(ts, views)
+        else:
+            return self._computeXcorrImod(ts, views)
+
+    def _selectViews(self, ts):
+        """Indexes of the views of ts to align"""
+        from tomoj import pipeline
+        views = None
+        if self.excludeDisabledViews:
+            views = [index for index, tiltImage in enumerate(ts) if tiltImage.isEnabled()]
+        tsId = ts.getTsId()
+        return pipeline.selectViews(self._getTsTmpPath(tsId, '%s.st' % tsId), views,
+                                    self.excludeDarkViews.get())
+
+    def _getQualityFileName(self, tsId):
+        return self._getExtraPath(tsId, '%s_quality.npy' % tsId)
+
+    def _getPatchesFileName(self, tsId):
+        return self._getExtraPath(tsId, '%s_patches.npz' % tsId)
+
+    def _computesPatchShifts(self):
+        return self.localShifts and self.xcorrEngine.get() == XCORR_ENGINE_TOMOJ
+
+    @staticmethod
+    def _getQualityAttribute(field):
+        """Attribute of the output tilt-images with a quality value,
+        e.g. _tomojPeakHeight"""
+        return '_tomoj%s%s' % (field[0].upper(), field[1:])
+
+    def _getViewsFileName(self, tsId):
+        return self._getExtraPath(tsId, '%s_views.npy' % tsId)
+
+    def _loadViews(self, tsId):
+        """Indexes of the aligned views of a tilt-series"""
+        import numpy as np
+        return np.load(self._getViewsFileName(tsId)).tolist()
+
+    def _getMatricesFileName(self, tsId):
+        return self._getExtraPath(tsId, '%s_prexg.npy' % tsId)
+
+    def _getInputMatricesFileName(self, tsId):
+        return self._getTsTmpPath(tsId, '%s_input.npy' % tsId)
+
+    def _getScratchDir(self):
+        """Folder of this protocol in the node-local scratch, None when it is
+        not set or with MPI, whose nodes do not share it"""
+        if self._useMpi():
+            return None
+        return self._getNodeScratchDir()
+
+    def _getNodeScratchDir(self):
+        """Folder of this protocol in the node-local scratch of whatever node
+        uses it, None when it is not set"""
+        scratchDir = Plugin.getVar(TOMOJ_SCRATCH)
+        if not scratchDir:
+            return None
+        return os.path.join(scratchDir, self.getProject().getShortName(),
+                            os.path.basename(self.getWorkingDir()))
+
+    def _getPipelineArgs(self, command):
+        """Arguments of a tomoj.pipeline job. With MPI, each job stages its
+        stacks through the scratch folder of the node it runs on."""
+        args = "-m tomoj.pipeline"
+        if self._useMpi() and self._getNodeScratchDir():
+            args += " --scratch %s" % self._getNodeScratchDir()
+        return args + " " + command
+
+    def _getTsTmpPath(self, tsId, *paths):
+        """Temporary files of a tilt-series, in the scratch folder when set"""
+        scratchDir = self._getScratchDir()
+        if scratchDir:
+            return os.path.join(scratchDir, tsId, *paths)
+        return self._getTmpPath(tsId, *paths)
+
+    def _getScratchOutputPath(self, fileName):
+        """Scratch file where an output is written before moving it to the project"""
+        outputDir = os.path.join(self._getScratchDir(), 'output')
+        path.makePath(outputDir)
+        return os.path.join(outputDir, fileName)
+
+    def _prefetchNextStack(self):
+        """Start copying the stack of the next tilt-series to convert to the
+        scratch folder"""
+        for tsId, stackFileName in list(self._stackQueue.items())[:1]:
+            path.makePath(self._getTsTmpPath(tsId))
+            self._stager.prefetch(stackFileName, self._getTsTmpPath(tsId, '%s.st' % tsId))
+
+    def _getTmpDir(self):
+        """Folder with the temporary files of all the tilt-series"""
+        return self._getScratchDir() or self._getTmpPath()
+
+    def _getStepWorkers(self):
+        """Steps run concurrently by the steps executor"""
+        workers = self.numberOfMpi.get() if self._useMpi() else self.numberOfThreads.get()
+        return max(1, workers - 1)
+
+    def _waitForTmpSpace(self, ts):
+        """Wait until the temporary files of ts fit within the maximum size.
+        Steps waiting here never take all the executor threads, so the
+        tilt-series in progress can always finish and remove theirs."""
+        maxSize = self.maxTmpSize.get() * 1024 ** 3
+        if maxSize <= 0:
+            return
+        fileNames = {tiltImage.getFileName() for tiltImage in ts}
+        expectedSize = 0 if self._usesInputStack(ts) and not self._getScratchDir() \
+            else tomojUtils.filesSize(fileNames)
+
+        with self._tmpReleased:
+            while True:
+                tmpSize = tomojUtils.folderSize(self._getTmpDir())
+                if tmpSize == 0 or tmpSize + expectedSize <= maxSize or \
+                        self._waitingConverts + 1 >= self._getStepWorkers():
+                    return
+                self.info("Temporary files take %s, waiting to convert %s"
+                          % (prettySize(tmpSize), ts.getTsId()))
+                self._waitingConverts += 1
+                # Also polled: files may be removed by other means
+                self._tmpReleased.wait(timeout=60)
+                self._waitingConverts -= 1
+
+    def _releaseTmp(self, tsId):
+        """Remove the temporary files of a processed tilt-series, or move them
+        to the extra folder when they are kept for debugging"""
+        tmpPrefix = self._getTsTmpPath(tsId)
+        if self.keepTmpFiles:
+            path.moveTree(tmpPrefix, self._getExtraPath(tsId))
+        else:
+            path.cleanPath(tmpPrefix)
+        with self._tmpReleased:
+            self._tmpReleased.notify_all()
+
+    @staticmethod
+    def _isMrcTs(ts):
+        """Whether all the tilt-images of ts are in MRC files"""
+        return all(os.path.splitext(tiltImage.getFileName())[1].lower() in MRC_EXTENSIONS
+                   for tiltImage in ts)
+
+    def _getMemoryLimit(self):
+        """Bytes the processing of a tilt-series may take, None if unlimited"""
+        if self.memoryLimit.get() <= 0:
+            return None
+        return self.memoryLimit.get() * 1024 ** 3 / self._getStepWorkers()
+
+    def _usesInputStack(self, ts):
+        """Whether the input stack is used as it is, with its transformation
+        composed into the alignment"""
+        from tomoj import alignment
+        return self._isSingleOrderedStack(ts) and \
+            (alignment.isIdentity(self._getInputTransforms(ts)) or
+             self.xcorrEngine.get() == XCORR_ENGINE_TOMOJ)
+
+    def _writesXfFiles(self):
+        return self.writeXfFiles or self.xcorrEngine.get() != XCORR_ENGINE_TOMOJ
+
+    def _getXcorrResultFileNames(self, tsId):
+        """Files written by the cross-correlation of a tilt-series"""
+        fileNames = [self._getMatricesFileName(tsId), self._getViewsFileName(tsId)]
+        if self.xcorrEngine.get() == XCORR_ENGINE_TOMOJ:
+            fileNames.append(self._getQualityFileName(tsId))
+        if self._computesPatchShifts():
+            fileNames.append(self._getPatchesFileName(tsId))
+        if self._writesXfFiles():
+            fileNames += [self._getExtraPath(tsId, '%s.prexf' % tsId),
+                          self._getExtraPath(tsId, '%s.prexg' % tsId)]
+        return fileNames
+
+    def _getXcorrCacheKey(self, ts):
+        """Cache key of everything the cross-correlation result depends on"""
+        import numpy as np
+        from tomoj import cache
+        return cache.cacheKey(cache.stackSignature([tiltImage.getFileName() for tiltImage in ts]),
+                              [tiltImage.getIndex() for tiltImage in ts],
+                              np.array([tiltImage.getTiltAngle() for tiltImage in ts]),
+                              self._getInputTransforms(ts),
+                              self.xcorrEngine.get(), self.rotationAngle.get(),
+                              FILTER_SIGMA1, FILTER_SIGMA2, FILTER_RADIUS2,
+                              self.pyramidLevels.get(), self._writesXfFiles(),
+                              self.excludeDisabledViews.get(),
+                              # The enabled views only matter when the others are excluded
+                              [tiltImage.isEnabled() for tiltImage in ts]
+                              if self.excludeDisabledViews else None,
+                              self.excludeDarkViews.get(), self._computesPatchShifts(),
+                              self.patchSize.get(), self.patchOverlap.get())
+
+    def _computeXcorrTomoj(self, ts, views):
+        """Compute the alignment matrices with the TomoJ engine"""
+        import numpy as np
+        from tomoj import pipeline
+        tsId = ts.getTsId()
+        tmpPrefix = self._getTsTmpPath(tsId)
+        inputTsFileName = os.path.join(tmpPrefix, '%s.st' % tsId)
+        matricesFileName = self._getMatricesFileName(tsId)
+        prexfFileName, prexgFileName = None, None
+        if self._writesXfFiles():
+            prexfFileName = self._getExtraPath(tsId, '%s.prexf' % tsId)
+            prexgFileName = self._getExtraPath(tsId, '%s.prexg' % tsId)
+
+        if self._useMpi():
+            """Run as a job so that the MPI executor sends it to a free node"""
+            argsXcorr = self._getPipelineArgs('xcorr') + \
+                        " --input %s --tilts %s --matrices %s --quality %s --state %s " \
+                        "--rotation-angle %f --pyramid-levels %d --workers %d" \
+                        % (inputTsFileName, os.path.join(tmpPrefix, '%s.rawtlt' % tsId),
+                           matricesFileName, self._getQualityFileName(tsId),
+                           self._getXcorrStateFileName(tsId),
+                           self.rotationAngle.get(), self.pyramidLevels.get(),
+                           self._getPairWorkers())
+            if prexgFileName:
+                argsXcorr += " --prexf %s --prexg %s" % (prexfFileName, prexgFileName)
+            if os.path.exists(self._getInputMatricesFileName(tsId)):
+                argsXcorr += " --xform %s" % self._getInputMatricesFileName(tsId)
+            if len(views) < ts.getSize():
+                argsXcorr += " --views %s" % ','.join(map(str, views))
+            if self._computesPatchShifts():
+                argsXcorr += " --patches %s --patch-size %d --patch-overlap %f" \
+                             % (self._getPatchesFileName(tsId), self.patchSize.get(),
+                                self.patchOverlap.get())
+            if self._getMemoryLimit():
+                argsXcorr += " --memory %f" % (self._getMemoryLimit() / 1024 ** 3)
+            self.runJob(sys.executable, argsXcorr)
+            return np.load(matricesFileName)
+
+        cpuTimes = []
+        matrices = pipeline.alignStack(inputTsFileName,
+                                       [tiltImage.getTiltAngle() for tiltImage in ts],
+                                       matricesFileName=matricesFileName,
+                                       prexfFileName=prexfFileName,
+                                       prexgFileName=prexgFileName,
+                                       inputMatricesFileName=self._getInputMatricesFileName(tsId),
+                                       stateFileName=self._getXcorrStateFileName(tsId),
+                                       rotationAngle=self.rotationAngle.get(),
+                                       pyramidLevels=self.pyramidLevels.get(),
+                                       workers=self._getPairWorkers(),
+                                       views=views,
+                                       qualityFileName=self._getQualityFileName(tsId),
+                                       patchesFileName=self._getPatchesFileName(tsId)
+                                       if self._computesPatchShifts() else None,
+                                       patchSize=self.patchSize.get(),
+                                       patchOverlap=self.patchOverlap.get(),
+                                       memoryLimit=self._getMemoryLimit(),
+                                       cpuTimes=cpuTimes)
+        if hasattr(self._stepData, 'workerCpuTime'):
+            self._stepData.workerCpuTime += sum(cpuTimes)
+        return matrices
+
+    def _useMpi(self):
+        return self.numberOfMpi.get() > 1
+
+    def _getPairWorkers(self):
+        """Processes to correlate the view pairs of a tilt-series. Threads that
+        are not needed to run tilt-series in parallel are used within them."""
+        nThreads = max(1, self.numberOfThreads.get())
+        nSeries = max(1, self.inputSetOfTiltSeries.get().getSize())
+        return max(1, nThreads // min(nThreads, nSeries))
+
+    def _getXcorrStateFileName(self, tsId):
+        return self._getExtraPath(tsId, '%s_xcorr.npz' % tsId)
+
+    def _computeXcorrImod(self, ts, views):
+        """Compute the alignment matrices with tiltxcorr and xftoxg"""
+        import numpy as np
+        from tomoj import alignment
+        tsId = ts.getTsId()
         extraPrefix = self._getExtraPath(tsId)
-        tmpPrefix = self._getTmpPath(tsId)
+        tmpPrefix = self._getTsTmpPath(tsId)
 
         paramsXcorr = {
             'input': os.path.join(tmpPrefix, '%s.st' % tsId),
             'output': os.path.join(extraPrefix, '%s.prexf' % tsId),
             'tiltfile': os.path.join(tmpPrefix, '%s.rawtlt' % tsId),
             'RotationAngle': self.rotationAngle.get(),
-            'FilterSigma1': 0.03,
-            'FilterSigma2': 0.05,
-            'FilterRadius2': 0.25
+            'FilterSigma1': FILTER_SIGMA1,
+            'FilterSigma2': FILTER_SIGMA2,
+            'FilterRadius2': FILTER_RADIUS2
         }
         argsXcorr = "-input %(input)s " \
                     "-output %(output)s " \
@@ -128,6 +1077,9 @@ class ProtTomojXcorrPrealignment(EMProtocol, ProtTomoBase):
                     "-FilterSigma1 %(FilterSigma1)f " \
                     "-FilterSigma2 %(FilterSigma2)f " \
                     "-FilterRadius2 %(FilterRadius2)f"
+        skippedViews = sorted(set(range(ts.getSize())) - set(views))
+        if skippedViews:
+            argsXcorr += " -SkipViews %s" % ','.join(str(view + 1) for view in skippedViews)
         self.runJob('tiltxcorr', argsXcorr % paramsXcorr)
 
         paramsXftoxg = {
@@ -138,76 +1090,100 @@ class ProtTomojXcorrPrealignment(EMProtocol, ProtTomoBase):
                      "-goutput %(goutput)s"
         self.runJob('xftoxg', argsXftoxg % paramsXftoxg)
 
-        """Generate output tilt series"""
-        outputSetOfTiltSeries = self.getOutputSetOfTiltSeries()
+        matrices = alignment.readXfFile(paramsXftoxg['goutput'])
+        if len(views) < ts.getSize():
+            matrices = alignment.bridgeMatrices(matrices[views], views, ts.getSize())
+        np.save(self._getMatricesFileName(tsId), matrices)
+        return matrices
+
+    def _getInterpolationBinning(self):
+        """Virtual interpolated tilt-series keep the input pixel size"""
+        return 1 if self.virtualInterpolation else int(self.binning.get())
+
+    def _getInputStackTransforms(self, ts):
+        """Alignment transforms referred to the input tilt-images. They already
+        include the input transforms unless these were applied to a copy of
+        the stack."""
+        import numpy as np
         tsId = ts.getTsId()
-        alignmentMatrix = utils.formatTransformationMatrix(self._getExtraPath('%s/%s.prexg' % (tsId, tsId)))
-        newTs = tomoObj.TiltSeries(tsId=tsId)
-        newTs.copyInfo(ts)
-        outputSetOfTiltSeries.append(newTs)
+        matrices = np.load(self._getMatricesFileName(tsId))
+        if not self._usesInputStack(ts):
+            matrices = matrices @ self._getInputTransforms(ts)
+        return matrices
+
+    @staticmethod
+    def _getInputTransforms(ts):
+        """(N, 3, 3) transformation matrices of the tilt-series, unit when missing"""
+        import numpy as np
+        matrices = np.tile(np.eye(3), (ts.getSize(), 1, 1))
         for index, tiltImage in enumerate(ts):
-            newTi = tomoObj.TiltImage()
-            newTi.copyInfo(tiltImage, copyId=True)
-            newTi.setLocation(tiltImage.getLocation())
-            transform = data.Transform()
-            transform.setMatrix(alignmentMatrix[:, :, index])
-            newTi.setTransform(transform)
-            newTs.append(newTi)
-        newTs.write()
-        outputSetOfTiltSeries.update(newTs)
-        outputSetOfTiltSeries.write()
-        self._store()
+            if tiltImage.hasTransform():
+                matrices[index] = tiltImage.getTransform().getMatrix()
+        return matrices
 
-    def computeInterpolatedStackStep(self, tsObjId):
-        outputInterpolatedSetOfTiltSeries = self.getOutputInterpolatedSetOfTiltSeries()
-        ts = self.inputSetOfTiltSeries.get()[tsObjId]
+    @staticmethod
+    def _isSingleOrderedStack(ts):
+        """Whether the tilt-images are the slices of a single MRC stack in order,
+        so the stack can be used directly"""
+        fileNames = set()
+        indexes = []
+        for tiltImage in ts:
+            fileNames.add(tiltImage.getFileName())
+            indexes.append(tiltImage.getIndex())
+        return len(fileNames) == 1 and \
+            os.path.splitext(fileNames.pop())[1].lower() in MRC_EXTENSIONS and \
+            indexes == list(range(1, len(indexes) + 1))
 
-        tsId = ts.getTsId()
-        newTs = tomoObj.TiltSeries(tsId=tsId)
-        newTs.copyInfo(ts)
-        outputInterpolatedSetOfTiltSeries.append(newTs)
-        extraPrefix = self._getExtraPath(tsId)
-        tmpPrefix = self._getTmpPath(tsId)
+    def _getOutputTs(self, outputSet, ts, attributes=None):
+        """Tilt-series of outputSet with the tsId of ts, together with the ids
+        of its tilt-images. It is appended to the set if it is not there yet.
+        Called with the output lock held.
 
-        paramsAlignment = {
-            'input': os.path.join(tmpPrefix, '%s.st' % tsId),
-            'output': os.path.join(extraPrefix, '%s_preali.st' % tsId),
-            'xform': os.path.join(extraPrefix, "%s.prexg" % tsId),
-            'bin': int(self.binning.get()),
-            'imagebinned': 1.0
-        }
-        argsAlignment = "-input %(input)s " \
-                        "-output %(output)s " \
-                        "-xform %(xform)s " \
-                        "-bin %(bin)d " \
-                        "-imagebinned %(imagebinned)s"
-        self.runJob('newstack', argsAlignment % paramsAlignment)
+        :param attributes: {name: value} attributes of the tilt-series. They
+            are set before it is appended, as the first append fixes the
+            columns of the set.
+        """
+        import tomo.objects as tomoObj
+        pending = self._pendingTs.get((outputSet.getFileName(), ts.getTsId()))
+        if pending is not None:
+            # Not written yet, the set would return its last written state
+            outputTs, existingIds = pending[1], {tiltImage.getObjId() for tiltImage in pending[1]}
+        else:
+            outputTs, existingIds = None, set()
+            for outputTs in outputSet.iterItems(where='_tsId="%s"' % ts.getTsId()):
+                outputTs.enableAppend()
+                existingIds = {tiltImage.getObjId() for tiltImage in outputTs}
+                break
+        if outputTs is not None:
+            for name, value in (attributes or {}).items():
+                setattr(outputTs, name, value)
+            return outputTs, existingIds
 
-        for index, tiltImage in enumerate(ts):
-            newTi = tomoObj.TiltImage()
-            newTi.copyInfo(tiltImage, copyId=True)
-            newTi.setLocation(index + 1, (os.path.join(extraPrefix, '%s_preali.st' % tsId)))
-            if self.binning > 1:
-                newTi.setSamplingRate(tiltImage.getSamplingRate() * int(self.binning.get()))
-            newTs.append(newTi)
-        if self.binning > 1:
-            newTs.setSamplingRate(ts.getSamplingRate() * int(self.binning.get()))
-        newTs.write()
-        outputInterpolatedSetOfTiltSeries.update(newTs)  # update items and size info
-        outputInterpolatedSetOfTiltSeries.write()
-        self._store()
+        newTs = tomoObj.TiltSeries(tsId=ts.getTsId())
+        newTs.copyInfo(ts)
+        for name, value in (attributes or {}).items():
+            setattr(newTs, name, value)
+        outputSet.append(newTs)
+        return newTs, set()
 
-        """Debug code"""
-        path.moveTree(self._getTmpPath(), self._getExtraPath())
+    @staticmethod
+    def _appendOrUpdate(outputTs, tiltImage, existingIds):
+        if tiltImage.getObjId() in existingIds:
+            outputTs.update(tiltImage)
+        else:
+            outputTs.append(tiltImage)
 
-    # --------------------------- UTILS functions ----------------------------
     def getOutputSetOfTiltSeries(self):
         if not hasattr(self, "outputSetOfTiltSeries"):
             outputSetOfTiltSeries = self._createSetOfTiltSeries()
             outputSetOfTiltSeries.copyInfo(self.inputSetOfTiltSeries.get())
             outputSetOfTiltSeries.setDim(self.inputSetOfTiltSeries.get().getDim())
+            outputSetOfTiltSeries.setStreamState(Set.STREAM_OPEN)
             self._defineOutputs(outputSetOfTiltSeries=outputSetOfTiltSeries)
             self._defineSourceRelation(self.inputSetOfTiltSeries, outputSetOfTiltSeries)
+        else:
+            self._reopenOutput('outputSetOfTiltSeries')
+        self._openedOutputs.add('outputSetOfTiltSeries')
         return self.outputSetOfTiltSeries
 
     def getOutputInterpolatedSetOfTiltSeries(self):
@@ -215,14 +1191,25 @@ class ProtTomojXcorrPrealignment(EMProtocol, ProtTomoBase):
             outputInterpolatedSetOfTiltSeries = self._createSetOfTiltSeries(suffix='Interpolated')
             outputInterpolatedSetOfTiltSeries.copyInfo(self.inputSetOfTiltSeries.get())
             outputInterpolatedSetOfTiltSeries.setDim(self.inputSetOfTiltSeries.get().getDim())
-            if self.binning > 1:
+            outputInterpolatedSetOfTiltSeries.setStreamState(Set.STREAM_OPEN)
+            if self._getInterpolationBinning() > 1:
                 samplingRate = self.inputSetOfTiltSeries.get().getSamplingRate()
-                samplingRate *= self.binning.get()
+                samplingRate *= self._getInterpolationBinning()
                 outputInterpolatedSetOfTiltSeries.setSamplingRate(samplingRate)
             self._defineOutputs(outputInterpolatedSetOfTiltSeries=outputInterpolatedSetOfTiltSeries)
             self._defineSourceRelation(self.inputSetOfTiltSeries, outputInterpolatedSetOfTiltSeries)
+        else:
+            self._reopenOutput('outputInterpolatedSetOfTiltSeries')
+        self._openedOutputs.add('outputInterpolatedSetOfTiltSeries')
         return self.outputInterpolatedSetOfTiltSeries
 
+    def _reopenOutput(self, outputName):
+        """Allow appending to an output set of an execution being continued"""
+        if outputName not in self._openedOutputs:
+            outputSet = getattr(self, outputName)
+            outputSet.enableAppend()
+            outputSet.setStreamState(Set.STREAM_OPEN)
+
     # --------------------------- INFO functions ----------------------------
     def _summary(self):
         summary = []
@@ -238,19 +1225,32 @@ class ProtTomojXcorrPrealignment(EMProtocol, ProtTomoBase):
                               self.outputInterpolatedSetOfTiltSeries.getSize()))
         else:
             summary.append("Output classes not ready yet.")
+
+        stepTotals = tomojUtils.aggregateStepStats(tomojUtils.readStepStats(self._getStepStatsFileName()))
+        for stepName, total in stepTotals.items():
+            summary.append("%s (%d tilt-series): wall %.1f s, CPU %.1f s, external %.1f s, "
+                           "read %s, written %s. Slowest: %s (%.1f s)."
+                           % (stepName, total['count'], total['wallTime'], total['cpuTime'],
+                              total['externalTime'], prettySize(total['inputBytes']),
+                              prettySize(total['outputBytes']), total['slowestTsId'],
+                              total['slowestTime']))
         return summary
 
     def _methods(self):
         methods = []
+        if self.xcorrEngine.get() == XCORR_ENGINE_TOMOJ:
+            procedure = "the TomoJ cross-correlation procedure"
+        else:
+            procedure = "the IMOD procedure (tiltxcorr)"
         if not hasattr(self, 'outputInterpolatedSetOfTiltSeries'):
             methods.append("The transformation matrix has been calculated for %d "
-                           "Tilt-series using the IMOD procedure.\n"
-                           % (self.outputSetOfTiltSeries.getSize()))
+                           "Tilt-series using %s.\n"
+                           % (self.outputSetOfTiltSeries.getSize(), procedure))
         elif hasattr(self, 'outputInterpolatedSetOfTiltSeries'):
             methods.append("The transformation matrix has been calculated for %d "
-                           "Tilt-series using the IMOD procedure.\n"
+                           "Tilt-series using %s.\n"
                            "Also, interpolation has been completed for %d Tilt-series.\n"
-                           % (self.outputSetOfTiltSeries.getSize(),
+                           % (self.outputSetOfTiltSeries.getSize(), procedure,
                               self.outputInterpolatedSetOfTiltSeries.getSize()))
         else:
             methods.append("Output classes not ready yet.")
@@ -0,0 +1,151 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Staging of files between the project and a node-local scratch folder.
+
+Copies run in background threads, so that the stack of the next tilt-series
+is read while the current one is being aligned, and results are written back
+to the project while the next tilt-series is processed. Prefetches and
+write-backs have their own threads, so waiting for a write-back never waits
+for the copy of a large stack.
+
+With MPI, the jobs sent to the nodes stage their own files through the
+scratch folder of their node instead (see stagedFiles).
+"""
+
+import contextlib
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+PREFETCH_SUFFIX = '.prefetch'
+PARTIAL_SUFFIX = '.part'
+
+
+def _copyFile(source, destination):
+    """Copy source so that destination never exists partially written."""
+    partialFileName = destination + PARTIAL_SUFFIX
+    shutil.copyfile(source, partialFileName)
+    os.replace(partialFileName, destination)
+
+
+def _moveFile(source, destination):
+    _copyFile(source, destination)
+    os.remove(source)
+
+
+def _fileStat(fileName):
+    stat = os.stat(fileName)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class FileStager:
+    """Background copies between the project and the scratch folder."""
+
+    def __init__(self, workers=1):
+        self._prefetchExecutor = ThreadPoolExecutor(max_workers=workers)
+        # A single thread, so write-backs are done in the order they are queued
+        self._writeBackExecutor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._prefetches = {}  # destination -> (source, source stat, future)
+        self._writeBacks = []
+
+    def prefetch(self, source, destination):
+        """Start copying source next to destination. It is moved into place
+        by fetch, so files in use at destination are never touched."""
+        with self._lock:
+            if destination not in self._prefetches:
+                future = self._prefetchExecutor.submit(_copyFile, source,
+                                               destination + PREFETCH_SUFFIX)
+                self._prefetches[destination] = (source, _fileStat(source), future)
+
+    def fetch(self, source, destination):
+        """Copy source to destination, using its prefetched copy when it is
+        still up to date."""
+        with self._lock:
+            prefetched = self._prefetches.pop(destination, None)
+        if prefetched is not None:
+            prefetchSource, stat, future = prefetched
+            try:
+                future.result()
+                if prefetchSource == source and stat == _fileStat(source):
+                    os.replace(destination + PREFETCH_SUFFIX, destination)
+                    return
+            except OSError:
+                pass
+            if os.path.exists(destination + PREFETCH_SUFFIX):
+                os.remove(destination + PREFETCH_SUFFIX)
+        _copyFile(source, destination)
+
+    def writeBack(self, source, destination):
+        """Move source to destination in the background. Return its future,
+        done once this and the previous write-backs are done."""
+        with self._lock:
+            future = self._writeBackExecutor.submit(_moveFile, source, destination)
+            self._writeBacks.append(future)
+        return future
+
+    def wait(self):
+        """Wait for the pending write-backs. Raise the error of the first
+        one that failed."""
+        with self._lock:
+            writeBacks, self._writeBacks = self._writeBacks, []
+        for future in writeBacks:
+            future.result()
+
+
+@contextlib.contextmanager
+def stagedFiles(scratchDir, inputs=(), outputs=()):
+    """Stage the files of a job through a private folder of scratchDir. Yield
+    a function giving the local path of a file name: existing inputs are
+    copied in first, and the outputs that were written are moved to their
+    destinations, in order, once the job succeeds. Other files, and all of
+    them without scratchDir, are used in place."""
+    if not scratchDir:
+        yield lambda fileName: fileName
+        return
+
+    os.makedirs(scratchDir, exist_ok=True)
+    jobDir = tempfile.mkdtemp(dir=scratchDir)
+    localNames = {}
+    for fileName in list(inputs) + list(outputs):
+        if fileName and fileName not in localNames:
+            localNames[fileName] = os.path.join(jobDir, '%d_%s' % (len(localNames),
+                                                                   os.path.basename(fileName)))
+    try:
+        for fileName in inputs:
+            if fileName and os.path.exists(fileName):
+                _copyFile(fileName, localNames[fileName])
+        yield lambda fileName: localNames.get(fileName, fileName)
+        for fileName in outputs:
+            if fileName and os.path.exists(localNames[fileName]):
+                _moveFile(localNames[fileName], fileName)
+    finally:
+        shutil.rmtree(jobDir, ignore_errors=True)
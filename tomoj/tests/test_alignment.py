@@ -0,0 +1,89 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import unittest
+
+import numpy as np
+
+from tomoj import alignment, benchmark
+
+# Pixels
+RMS_TOLERANCE = 0.5
+MAX_TOLERANCE = 1.0
+
+
+class TestNeighbourShifts(unittest.TestCase):
+    """The composed neighbour shifts must recover the known shifts of a
+    synthetic tilt-series."""
+
+    def assertRecovered(self, size=256, nTilts=21, rotationAngle=0.0, pyramidLevels=1):
+        stack, tiltAngles, shifts = benchmark.syntheticTiltSeries(
+            size, nTilts, tiltRange=60.0, noise=0.5, maxShift=10.0,
+            rotationAngle=rotationAngle, seed=0)
+        neighbourShifts = alignment.computeNeighbourShifts(stack, tiltAngles,
+                                                           rotationAngle=rotationAngle,
+                                                           pyramidLevels=pyramidLevels)
+        matrices = alignment.composeShifts(neighbourShifts, tiltAngles, rotationAngle)
+        error = benchmark.alignmentError(matrices, shifts)
+        self.assertLess(error['rms'], RMS_TOLERANCE, error)
+        self.assertLess(error['max'], MAX_TOLERANCE, error)
+        return matrices
+
+    def testShifts(self):
+        matrices = self.assertRecovered()
+        np.testing.assert_allclose(matrices[:, 0:2, 0:2], np.tile(np.eye(2), (21, 1, 1)))
+        np.testing.assert_allclose(matrices[:, 0:2, 2].mean(axis=0), 0, atol=1e-9)
+
+    def testRotatedTiltAxis(self):
+        self.assertRecovered(rotationAngle=20.0)
+
+    def testPyramid(self):
+        self.assertRecovered(size=512, rotationAngle=-10.0, pyramidLevels=2)
+
+
+class TestComposeShifts(unittest.TestCase):
+
+    def testWithoutTiltAngles(self):
+        shifts = np.array([[0, 0], [1, 2], [-3, 0.5], [2, -1]])
+        matrices = alignment.composeShifts(shifts)
+        cumulative = np.cumsum(shifts, axis=0)
+        np.testing.assert_allclose(matrices[:, 0:2, 2], cumulative - cumulative.mean(axis=0))
+
+    def testStretchAboutCenter(self):
+        # Stretching about the image center instead of the view position
+        # shifts the stretched views, the recursion must remove that error
+        stack, tiltAngles, shifts = benchmark.syntheticTiltSeries(
+            256, 21, tiltRange=60.0, noise=0.5, maxShift=10.0, seed=1)
+        neighbourShifts = alignment.computeNeighbourShifts(stack, tiltAngles)
+        stretched = benchmark.alignmentError(alignment.composeShifts(neighbourShifts, tiltAngles),
+                                             shifts)
+        plain = benchmark.alignmentError(alignment.composeShifts(neighbourShifts), shifts)
+        self.assertLess(stretched['rms'], plain['rms'])
+        self.assertLess(stretched['max'], MAX_TOLERANCE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import unittest
+
+from tomoj import benchmark
+
+# Seconds, as checked by: python -m tomoj.benchmark --import-only --import-budget 0.05
+IMPORT_BUDGET = 0.05
+
+
+class TestProtocolsImport(unittest.TestCase):
+    """Scipion imports the protocols of every plugin to build its protocol
+    lists, so importing ours must be fast and leave the processing modules
+    to the steps."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.report = benchmark.measureImport()
+        if cls.report is None:
+            raise unittest.SkipTest('Scipion is not installed: %s'
+                                    % ', '.join(benchmark.IMPORT_BASELINE))
+
+    def testImportTime(self):
+        self.assertLessEqual(self.report['importTime'], IMPORT_BUDGET)
+
+    def testLazyImports(self):
+        self.assertEqual(self.report['heavyImports'], [],
+                         'Importing the protocols imported %s'
+                         % ', '.join(self.report['heavyImports']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import tracemalloc
+import unittest
+
+import numpy as np
+
+from tomoj import alignment
+
+
+class TestXcorrMemory(unittest.TestCase):
+    """The peak memory of computeNeighbourShifts must stay within the
+    estimate used to fit the batches and workers to a memory limit."""
+
+    def assertWithinEstimate(self, shape, pairsPerBatch, pyramidLevels=1):
+        nImages = pairsPerBatch + 2
+        stack = np.random.default_rng(0).normal(size=(nImages,) + shape).astype(np.float32)
+        tiltAngles = np.linspace(-30, 30, nImages)
+        tracemalloc.start()
+        try:
+            alignment.computeNeighbourShifts(stack, tiltAngles, rotationAngle=5.0,
+                                             pairsPerBatch=pairsPerBatch,
+                                             pyramidLevels=pyramidLevels,
+                                             returnQuality=True)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        estimate = alignment.xcorrMemory(shape, pairsPerBatch, pyramidLevels)
+        self.assertLessEqual(peak, estimate,
+                             'peak of %d bytes over the estimate of %d bytes for %s views, '
+                             '%d pairs per batch and %d pyramid levels'
+                             % (peak, estimate, shape, pairsPerBatch, pyramidLevels))
+
+    def testSinglePair(self):
+        self.assertWithinEstimate((1024, 1024), 1)
+
+    def testBatch(self):
+        self.assertWithinEstimate((1024, 1024), 4)
+
+    def testFullBatch(self):
+        self.assertWithinEstimate((1024, 1024), alignment.PAIRS_PER_BATCH)
+
+    def testLargeViews(self):
+        self.assertWithinEstimate((2048, 2048), 2)
+
+    def testBandedResampling(self):
+        # More pixels than RESAMPLE_BLOCK, resampled in bands
+        self.assertWithinEstimate((1024, 4608), 1)
+
+    def testPyramid(self):
+        self.assertWithinEstimate((2048, 2048), 2, pyramidLevels=2)
+
+    def testFitPairsPerBatch(self):
+        shape = (2048, 2048)
+        memoryLimit = 512 * 1024 ** 2
+        pairsPerBatch = alignment.fitPairsPerBatch(shape, memoryLimit)
+        self.assertLessEqual(alignment.xcorrMemory(shape, pairsPerBatch), memoryLimit)
+        self.assertGreater(alignment.xcorrMemory(shape, pairsPerBatch + 1), memoryLimit)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mrcfile
+import numpy as np
+
+from tomoj import benchmark, pipeline
+
+
+class TestStagedJobs(unittest.TestCase):
+    """The pipeline jobs give the same results when their stacks are staged
+    through a scratch folder, as the MPI jobs of the protocol do."""
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workDir)
+        stack, tiltAngles, _ = benchmark.syntheticTiltSeries(128, 7, 45, 0.5, 4, 0.0, 1)
+        self.imagesFileName = self._path('images.txt')
+        with open(self.imagesFileName, 'w') as f:
+            for n, view in enumerate(stack):
+                viewFileName = self._path('view%d.mrc' % n)
+                with mrcfile.new(viewFileName) as mrc:
+                    mrc.set_data(view.astype(np.float32))
+                f.write('1 %s\n' % viewFileName)
+        self.tiltsFileName = self._path('tilts.rawtlt')
+        np.savetxt(self.tiltsFileName, tiltAngles)
+
+    def _path(self, *paths):
+        return os.path.join(self.workDir, *paths)
+
+    def _runJobs(self, suffix, scratchDir=None):
+        """Convert, align and interpolate, return the output file names."""
+        stackFileName = self._path('ts%s.st' % suffix)
+        matricesFileName = self._path('ts%s_prexg.npy' % suffix)
+        alignedFileName = self._path('ts%s_preali.st' % suffix)
+        prefix = ['--scratch', scratchDir] if scratchDir else []
+        pipeline.main(prefix + ['convert', '--images', self.imagesFileName,
+                                '--output', stackFileName])
+        pipeline.main(prefix + ['xcorr', '--input', stackFileName, '--tilts', self.tiltsFileName,
+                                '--matrices', matricesFileName,
+                                '--state', self._path('ts%s_xcorr.npz' % suffix)])
+        pipeline.main(prefix + ['interpolate', '--input', stackFileName,
+                                '--xform', matricesFileName, '--output', alignedFileName])
+        return stackFileName, matricesFileName, alignedFileName
+
+    def testScratch(self):
+        scratchDir = self._path('scratch')
+        inPlace = self._runJobs('')
+        staged = self._runJobs('_staged', scratchDir)
+
+        self.assertEqual(os.listdir(scratchDir), [])
+        for fileName, stagedFileName in zip(inPlace, staged):
+            if fileName.endswith('.npy'):
+                np.testing.assert_array_equal(np.load(fileName), np.load(stagedFileName))
+            else:
+                with mrcfile.open(fileName) as mrc, mrcfile.open(stagedFileName) as stagedMrc:
+                    np.testing.assert_array_equal(mrc.data, stagedMrc.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
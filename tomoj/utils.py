@@ -0,0 +1,99 @@
+# **************************************************************************
+# *
+# * Authors:     Federico P. de Isidro Gomez (fp.deisidro@cnb.csi.es) [1]
+# *
+# * [1] Centro Nacional de Biotecnologia, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import csv
+import json
+import os
+from collections import OrderedDict
+
+STEP_STATS_FIELDS = ['step', 'tsId', 'wallTime', 'cpuTime', 'externalTime',
+                     'inputBytes', 'outputBytes']
+
+
+def filesSize(fileNames):
+    """Total size in bytes of the given files, following links. Missing files
+    are ignored."""
+    size = 0
+    for fileName in set(fileNames):
+        if os.path.exists(fileName):
+            size += os.path.getsize(fileName)
+    return size
+
+
+def folderSize(folder):
+    """Disk usage in bytes of the files below folder, without following
+    links. Files removed while walking are ignored."""
+    size = 0
+    for root, _, fileNames in os.walk(folder):
+        for fileName in fileNames:
+            try:
+                size += os.lstat(os.path.join(root, fileName)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def appendStepStats(fileName, stats):
+    """Append the stats of a step as a line of a JSON lines file."""
+    with open(fileName, 'a') as f:
+        f.write(json.dumps(stats) + '\n')
+
+
+def readStepStats(fileName):
+    """Stats of all the steps recorded in fileName."""
+    if not os.path.exists(fileName):
+        return []
+    with open(fileName) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def aggregateStepStats(records):
+    """Totals per step name, keeping the order in which steps first appear,
+    and the tsId of the slowest execution of each of them."""
+    totals = OrderedDict()
+    for record in records:
+        total = totals.setdefault(record['step'], {'count': 0, 'slowestTsId': None,
+                                                   'slowestTime': -1})
+        total['count'] += 1
+        for field in STEP_STATS_FIELDS[2:]:
+            total[field] = total.get(field, 0) + record[field]
+        if record['wallTime'] > total['slowestTime']:
+            total['slowestTime'] = record['wallTime']
+            total['slowestTsId'] = record['tsId']
+    return totals
+
+
+def exportStepStats(records, csvFileName=None, jsonFileName=None):
+    """Write the step stats as CSV and/or JSON."""
+    if csvFileName:
+        with open(csvFileName, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=STEP_STATS_FIELDS)
+            writer.writeheader()
+            for record in records:
+                writer.writerow(record)
+    if jsonFileName:
+        with open(jsonFileName, 'w') as f:
+            json.dump({'steps': records, 'totals': aggregateStepStats(records)}, f, indent=2)